@@ -3,7 +3,8 @@ import logging
 import pandas as pd
 import rpy2.robjects as ro
 
-from utils.clustering import Cluster
+from utils.checkpoint import RunDirectory
+from utils.clustering import run_grid
 from utils.data_loader import (
     all_covariates,
     get_covariates,
@@ -125,39 +126,22 @@ def main():
 
     all_results: list[ModelPerformance] = []
 
-    model_result = ModelPerformance(name=model.name)
-
-    it = 1
-    for model_params in model.yield_test_cases():
-        print("==========================")
-        print("\nCASE {}/{}\n".format(it, model.num_experiments))
-        print("==========================")
-        # use yearly data
-        model_args = model_params | model.load_model_specific_data(
-            data=data, yearly_time_series=pm25_timeseries, model_params=model_params
-        )
-        res_cluster, time_needed = Cluster.cluster(model=model.name, **model_args)
-        print(res_cluster.keys())
-        yearly_result = YearlyPerformance(
-            config=model_params,
-            yearly_result_decomposed=Analyse.analyze_yearly_performance(
-                py_res=res_cluster,
-                target=pm25_timeseries,
-                time_needed=time_needed,
-                salso_args=salso_args,
-            ),
-        )
-        # save_to_visualize_cluster = YearlyClustering(
-        #     yearly_decomposed_result=yearly_result, data=data
-        # )
-        # plot_weekly_clustering_kpi_overview(yearly_result=yearly_result)
-        # plot_clustering(save_to_visualize_cluster, method_name=model.name)
+    # test cases run in parallel, the table keeps the order of the grid; an
+    # interrupted sweep resumes from the checkpoints in its run directory
+    model_result = run_grid(
+        model=model,
+        data=data,
+        pm25_timeseries=pm25_timeseries,
+        num_weeks=pm25_timeseries.shape[1],
+        salso_args=salso_args,
+        run_dir=RunDirectory("drpm_{}_{}".format(experiment_case, prior_case)),
+        # keep the posteriors of all configurations on disk for comparisons
+        spill_posterior=True,
+    )
+    for yearly_result in model_result.test_cases:
         print(yearly_result.list_of_weekly["waic"])
         print(yearly_result.list_of_weekly["lpml"])
         print(yearly_result.list_of_weekly["max_pm25_diff"])
-        # trace_plots(res_cluster, model=model.name)
-        model_result.add_testcase(yearly_result=yearly_result)
-        it += 1
 
     table = model_result.to_table(select_params=select_params[experiment_case])
     python_to_latex(
@@ -1,6 +1,7 @@
 import rpy2.robjects as ro
 
-from utils.clustering import yearly_evaluation
+from utils.checkpoint import RunDirectory
+from utils.clustering import run_grid
 from utils.data_loader import load_data, yearly_data_as_timeseries
 from utils.models import Model
 from utils.results import ModelPerformance
@@ -54,17 +55,14 @@ def main():
     all_results: list[ModelPerformance] = []
 
     for model in models:
-        model_result = ModelPerformance(name=model.name)
-        for model_params in model.yield_test_cases():
-            yearly_result = yearly_evaluation(
-                model=model,
-                model_params=model_params,
-                data=data,
-                pm25_timeseries=pm25_timeseries,
-                num_weeks=num_weeks,
-                salso_args=salso_args,
-            )
-            model_result.add_testcase(yearly_result=yearly_result)
+        model_result = run_grid(
+            model=model,
+            data=data,
+            pm25_timeseries=pm25_timeseries,
+            num_weeks=num_weeks,
+            salso_args=salso_args,
+            run_dir=RunDirectory("large_experiment_{}".format(model.name)),
+        )
         all_results.append(model_result)
 
 
@@ -3,8 +3,11 @@ import logging #used to incorporate logging functionality into the script. Loggi
 import pandas as pd #importing the Pandas library. Pandas is a powerful library for data manipulation and analysis, and it provides data structures like DataFrames that are commonly used in data science and machine learning tasks. A DataFrame is a two-dimensional, tabular data structure in the Pandas library for Python. It is similar to a spreadsheet or SQL table, where data is arranged in rows and columns. Each column can have a different data type, and you can perform various operations on the data, such as filtering, grouping, and aggregation.
 import rpy2.robjects as ro #imports the robjects module from the rpy2 library. rpy2 is a Python library that provides an interface to R, the statistical computing and graphics language. This library allows you to call R functions and use R objects directly from Python.
 
-from utils.clustering import Cluster
+from utils.checkpoint import RunDirectory, run_context
+from utils.clustering import run_weekly_fits, yearly_evaluation
 from utils.data_loader import (
+    CovariateCache,
+    WeeklyPartitionedData,
     all_covariates,
     get_covariates,
     get_numerical_covariates,
@@ -14,7 +17,8 @@ from utils.data_loader import (
 )
 from utils.magic import set_r_python_seed
 from utils.models import Model
-from utils.results import Analyse, ModelPerformance, YearlyPerformance
+from utils.parallel import default_n_workers, r_worker_pool
+from utils.results import ModelPerformance
 from utils.tables import python_to_latex
 from utils.visualize import (
     WeeklyClustering,
@@ -30,6 +34,8 @@ def main():
     set_r_python_seed() #the purpose of this function is to synchronize the random number generation seeds between NumPy (used in Python) and R. This synchronization is crucial for ensuring that both Python and R generate the same sequence of random numbers when required, contributing to the reproducibility of results. you are setting the seed for both the NumPy (Python) random number generator and the R random number generator. This ensures that the sequence of random numbers generated by these generators will be the same every time your code is run, providing reproducibility. In terms of output, there isn't any direct output or variable created that you can observe in the code. The effect of setting the seed becomes apparent when your code involves randomness, for example, in scenarios where you use random numbers or sampling. The purpose is to make your results reproducible. Without setting the seed, each run of your code could yield different results due to the inherent randomness involved in certain computations.For instance, if you have a part of your code that uses random numbers, setting the seed ensures that even though the numbers are technically random, they will be the same every time you run the code. This can be crucial for debugging, testing, and ensuring that others can obtain the same results when they run your code. 
     data = load_data() #loading your data from a CSV file, performing some data type conversions, and handling missing data. since i'm not providing any input value, i will considering the defalut ones, i.e. 2019 for the year and none for the week. having week = none means that i'm not filtering any specific week. since the load_dat function returns a pd.dataframe, data will be a Pandas DataFrame 
     pm25_timeseries = yearly_data_as_timeseries(data) # creating a matrix (pm25_timeseries) where each row represents the weekly pm2.5 values of one station over the entire year, and each column represents the pm2.5 values of all stations for a specific week. on the row i have the indexes of stations and the columns are teh time series for each specific station
+    weekly_data = WeeklyPartitionedData(data)
+    covariate_cache = CovariateCache(weekly_data)
     salso_args = {"loss": "binder", "maxNCluster": 0} #This line defines a dictionary named salso_args with two key-value pairs: "loss": "binder": This sets the value associated with the key "loss" to the string "binder". This suggests that there is a loss function involved, and it is specifically the "binder" loss function. "maxNCluster": 0: This sets the value associated with the key "maxNCluster" to the integer 0. This parameter seems to control the maximum number of clusters and is set to 0.
 
     sppm_args = { #sppm is the main function used to fit model with Guassian likelihood and spatial PPM as prior on partitions.
@@ -92,64 +98,51 @@ def main():
     all_results: list[ModelPerformance] = [] #The all_results variable is a list that is intended to store instances of the ModelPerformance class. It is initialized as an empty list.
     model_result = ModelPerformance(name=model.name) #creating an instance of the model performance class and assigning to the variable model_result. I'm calling here the constructor (initializer) of the ModelPerformance class. The name parameter is set to the name of the model, which is obtained from model.name (gaussian_ppmx in my case)
     #so now model result is an instance of the ModelPerformance class with the name attribute equal to gaussian_ppmx and the test_cases attribute equal to an empty list of elements belonging to the YearlyPerfromance class 
-    for model_params in model.yield_test_cases(): #model.yield_test_cases() is a generator function that yields different combinations of parameter values for your model. Each iteration of the loop (for model_params in model.yield_test_cases():) assigns model_params the value yielded by the generator, which is a dictionary representing a specific combination of parameters. So, model_params is a dictionary, and each iteration of the loop corresponds to a different combination of parameter values for your model. Inside the loop, you can access and use the individual parameter values using keys from the model_params dictionary
+    weeks = list(range(1, num_weeks))
+    # one pool of R workers fits the weeks of all test cases
+    executor = r_worker_pool(default_n_workers(len(weeks)))
+    # finished weeks (or years) are checkpointed, a rerun resumes from them
+    run_dir = RunDirectory("main_{}".format(model.name))
+    context = run_context(data, num_weeks, salso_args)
+    for case_index, model_params in enumerate(model.yield_test_cases()): #model.yield_test_cases() is a generator function that yields different combinations of parameter values for your model. Each iteration of the loop (for model_params in model.yield_test_cases():) assigns model_params the value yielded by the generator, which is a dictionary representing a specific combination of parameters. So, model_params is a dictionary, and each iteration of the loop corresponds to a different combination of parameter values for your model. Inside the loop, you can access and use the individual parameter values using keys from the model_params dictionary
         if model.uses_weekly_data: #we enter in this if bc we are considering gaussian_ppmx. the only one for which we do not use weekly data is drpm. WHY???
+            digest = run_dir.add_config(case_index, model_params, context=context)
             save_to_visualize_cluster = WeeklyClustering() #creating an instance of the WeeklyClustering class and assigning it to the variable save_to_visualize_cluster.
         
-            weekly_results = []
-            for week in range(1, num_weeks):
-                logging.info("Week {}/{}".format(week, num_weeks)) #logging informational messages. These messages are typically used for general information about the program's execution. Indeed I have imported the logging library at the beginning 
-                week_data = data[data["Week"] == week]
-
-                week_cov_rdf = get_covariates(
-                    week_data.copy().drop(columns=["Week"]),
-                    as_r_df=True,
-                    only_numerical=False,
-                )
-
-                model_args = model_params | model.load_model_specific_data(
-                    week_data, covariates=week_cov_rdf, model_params=model_params
-                )
-                res_cluster, time_needed = Cluster.cluster(
-                    model=model.name, **model_args
-                )
-                weekly_res = Analyse.analyze_weekly_performance(
-                    py_res=res_cluster,
-                    target=week_data["log_pm25"],
-                    time_needed=time_needed,
-                    salso_args=salso_args,
-                    model_name=model.name,
-                )
-
+            # the weeks are independent and fitted in parallel worker processes
+            weekly_results = run_weekly_fits(
+                model=model,
+                model_params=model_params,
+                weekly_data=weekly_data,
+                weeks=weeks,
+                salso_args=salso_args,
+                covariate_cache=covariate_cache,
+                run_dir=run_dir,
+                config_digest=digest,
+                executor=executor,
+            )
+            for week, weekly_res in zip(weeks, weekly_results):
                 # save the results for visualization
                 save_to_visualize_cluster.add_week(
-                    week_number=week, weekly_data=week_data, weekly_res=weekly_res
+                    week_number=week,
+                    weekly_data=weekly_data.week(week),
+                    weekly_res=weekly_res,
                 )
-                # plot the param distribution: trace plots and histograms
-                # param_distribution(res_cluster, model.name)
 
-                # save the results for performance evaluation
-                weekly_results.append(weekly_res)
-
-            # aggregate the performance metrics
-            yearly_result = YearlyPerformance(
-                config=model_params, weekly_results=weekly_results
-            )
+            # aggregate the performance metrics of the checkpointed weeks
+            yearly_result = run_dir.yearly_performance(case_index, weeks=weeks)
 
         else:
-            # use yearly data
-            model_args = model_params | model.load_model_specific_data(
-                data=data, yearly_time_series=pm25_timeseries, model_params=model_params
-            )
-            res_cluster, time_needed = Cluster.cluster(model=model.name, **model_args)
-            yearly_result = YearlyPerformance(
-                config=model_params,
-                yearly_result_decomposed=Analyse.analyze_yearly_performance(
-                    py_res=res_cluster,
-                    target=pm25_timeseries,
-                    time_needed=time_needed,
-                    salso_args=salso_args,
-                ),
+            # use yearly data, the year is checkpointed as well
+            yearly_result = yearly_evaluation(
+                model=model,
+                model_params=model_params,
+                data=data,
+                pm25_timeseries=pm25_timeseries,
+                num_weeks=num_weeks,
+                salso_args=salso_args,
+                run_dir=run_dir,
+                case_index=case_index,
             )
             save_to_visualize_cluster = YearlyClustering(
                 yearly_decomposed_result=yearly_result, data=data
@@ -161,6 +154,7 @@ def main():
         #     yearly_result=yearly_result, num_weeks=num_weeks
         # )
         model_result.add_testcase(yearly_result=yearly_result, show_to_console=True)
+    executor.shutdown()
     plot_clustering(save_to_visualize_cluster, method_name=model.name)
     print("Model results as table: ")
     test = model_result.to_table()
@@ -4,6 +4,7 @@ from utils.magic import log_time, set_r_python_seed
 import rpy2.robjects as ro
 
 from utils.models import Model
+from utils.result_cache import default_result_cache
 from utils.results import Analyse, ModelPerformance, YearlyPerformance
 
 import matplotlib.pyplot as plt
@@ -367,7 +368,10 @@ def main():
                 model_params=model_params,
                 spatial=priors[prior]["spatial"],
             )
-            res_cluster, time_needed = Cluster.cluster(model=model.name, **model_args)
+            # restyling the plots reuses the cached fits
+            res_cluster, time_needed = Cluster.cluster(
+                model=model.name, use_cache=True, salso_args=salso_args, **model_args
+            )
             yearly_result = YearlyPerformance(
                 config=model_params,
                 yearly_result_decomposed=Analyse.analyze_yearly_performance(
@@ -397,6 +401,8 @@ def main():
         filename="drpm_base_models_comparison",
         title="Comparison of different Prior Values for the non-spatial informed DRPM Model",
     )
+    # how many fits were loaded from the result cache instead of refitted
+    default_result_cache().report()
 
     #PRINT the ARImatrix
     for idx,model_result in enumerate(all_results):
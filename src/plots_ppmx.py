@@ -1,17 +1,31 @@
-from utils.clustering import Cluster
-from utils.data_loader import load_data, yearly_data_as_timeseries
+from utils.checkpoint import RunDirectory, run_context
+from utils.clustering import Cluster, run_weekly_fits
+from utils.data_loader import (
+    CovariateCache,
+    WeeklyPartitionedData,
+    load_data,
+    yearly_data_as_timeseries,
+)
 from utils.magic import log_time, set_r_python_seed
 import rpy2.robjects as ro
+import logging
 
 from utils.models import Model
-from utils.results import Analyse, ModelPerformance, YearlyPerformance
+from utils.parallel import default_n_workers, r_worker_pool
+from utils.results import Analyse, ModelPerformance
 #Matplotlib is a comprehensive 2D plotting library for Python. It enables the creation of static, animated, and interactive visualizations in Python. Matplotlib is widely used for generating plots and charts in various fields, including scientific research, data analysis, and visualization. Key features of Matplotlib include: Plotting Functions: Matplotlib provides a variety of functions for creating different types of plots, such as line plots, scatter plots, bar plots, histograms, and more. Customization: Users can extensively customize the appearance of plots, including colors, line styles, markers, labels, and annotations. Support for LaTeX: Matplotlib supports LaTeX for mathematical expressions and text rendering, making it a popular choice for creating plots in scientific publications. Multiple Backends: Matplotlib supports multiple backends for rendering graphics. It can create static images (e.g., PNG, JPEG) as well as interactive plots in Jupyter notebooks. Integration with NumPy: Matplotlib seamlessly integrates with NumPy, allowing users to plot data directly from NumPy arrays.
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
 import matplotlib.patches as mpatches
 import numpy as np
 
-from utils.visualize import YearlyClustering, _n_colors, plot_clustering, trace_plots
+from utils.visualize import (
+    WeeklyClustering,
+    YearlyClustering,
+    _n_colors,
+    plot_clustering,
+    trace_plots,
+)
 
 """
 Main script to plot the results of the gaussian_ppmx clustering and visualize the
@@ -219,8 +233,12 @@ def main():
     set_r_python_seed()
     data = load_data()
     pm25_timeseries = yearly_data_as_timeseries(data)
+    weekly_data = WeeklyPartitionedData(data)
+    covariate_cache = CovariateCache(weekly_data)
     salso_args = {"loss": "binder", "maxNCluster": 0}
     all_results: list[ModelPerformance] = []
+    # one pool of R workers fits the 52 weeks of all test cases
+    executor = r_worker_pool(default_n_workers(52))
 
     # for prior in priors.keys():
     for prior in ["paper_params", "mean_prev_year_and_lower_stddev", "mean_prev_year_and__higher_std"]:
@@ -259,59 +277,50 @@ def main():
 
         it = 1
         num_weeks = 53
-        for model_params in model.yield_test_cases():
+        # finished weeks are checkpointed, a rerun resumes from them
+        run_dir = RunDirectory("plots_ppmx_{}".format(prior))
+        context = run_context(data, num_weeks, salso_args)
+        for case_index, model_params in enumerate(model.yield_test_cases()):
             print("==========================")
             print("\nCASE {}/{}\n".format(it, model.num_experiments))
             print("==========================")
             # use yearly data
 
+            digest = run_dir.add_config(case_index, model_params, context=context)
             save_to_visualize_cluster = WeeklyClustering()
 
-            weekly_results = []
-            for week in range(1, num_weeks):
-                logging.info("Week {}/{}".format(week, num_weeks))
-                week_data = data[data["Week"] == week]
-
-                week_cov_rdf = get_covariates(
-                    week_data.copy().drop(columns=["Week"]),
-                    as_r_df=True,
-                    only_numerical=False,
-                )
-
-                model_args = model_params | model.load_model_specific_data(
-                    week_data, covariates=week_cov_rdf, model_params=model_params
-                )
-                res_cluster, time_needed = Cluster.cluster(
-                    model=model.name, **model_args
-                )
-                weekly_res = Analyse.analyze_weekly_performance(
-                    py_res=res_cluster,
-                    target=week_data["log_pm25"],
-                    time_needed=time_needed,
-                    salso_args=salso_args,
-                    model_name=model.name,
-                )
-
+            weeks = list(range(1, num_weeks))
+            # the weeks are independent and fitted in parallel worker processes
+            weekly_results = run_weekly_fits(
+                model=model,
+                model_params=model_params,
+                weekly_data=weekly_data,
+                weeks=weeks,
+                salso_args=salso_args,
+                covariate_cache=covariate_cache,
+                run_dir=run_dir,
+                config_digest=digest,
+                executor=executor,
+            )
+            for week, weekly_res in zip(weeks, weekly_results):
                 # save the results for visualization
                 save_to_visualize_cluster.add_week(
-                    week_number=week, weekly_data=week_data, weekly_res=weekly_res
+                    week_number=week,
+                    weekly_data=weekly_data.week(week),
+                    weekly_res=weekly_res,
                 )
-                # plot the param distribution: trace plots and histograms
-                # param_distribution(res_cluster, model.name)
 
-                # save the results for performance evaluation
-                weekly_results.append(weekly_res)
-
-            # aggregate the performance metrics
-            yearly_result = YearlyPerformance(
-                config=model_params, weekly_results=weekly_results
-            )
+            # aggregate the performance metrics of the checkpointed weeks
+            yearly_result = run_dir.yearly_performance(case_index, weeks=weeks)
 
             # trace_plots(res_cluster, model=model.name)
-            model_result.add_testcase(yearly_result=yearly_result)
+            model_result.add_testcase(
+                yearly_result=yearly_result, case_index=case_index
+            )
             it += 1
 
         all_results.append(model_result)
+    executor.shutdown()
 
     # VISUALIZE the clustering using plotly
     # plot_clustering(save_to_visualize_cluster, method_name=model.name)
@@ -0,0 +1,239 @@
+import hashlib
+import mmap
+import os
+import pickle
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+
+from utils.result_cache import digest_value
+from utils.results import ModelPerformance, YearlyPerformance
+
+"""
+Checkpoints of experiment sweeps. Every completed unit of a sweep, i.e. one week
+of a test case for the weekly models and the whole year for drpm, is written to a
+run directory as soon as it is done. A resumed sweep skips the completed units, and
+the tables are built from the run directory, so an interrupted and resumed sweep
+gives the same table as an uninterrupted one.
+
+The raw MCMC output of a fit can be spilled to memory-mapped ``.npy`` files
+instead of being held in memory, see ``spill_arrays``.
+"""
+
+runs_dir = os.path.join(Path(__file__).parent.parent.parent, "data/runs")
+# spilled arrays up to this size are loaded instead of mapped
+small_array_bytes = 64 * 1024
+
+
+class RunDirectory:
+    """
+    Directory of one sweep, e.g. ``RunDirectory("drpm_extensions")`` in
+    ``data/runs``:
+
+    - ``config-{case_index}.pkl``: the configuration of a test case
+    - ``{config digest}/week-{week}.pkl``: analysed result of one week
+    - ``{config digest}/year.pkl``: analysed result of a yearly model
+    - ``{config digest}/posterior[-week-{week}]/``: spilled raw MCMC output
+    """
+
+    def __init__(self, name: str, root: str = runs_dir):
+        self.path = os.path.join(root, name)
+        os.makedirs(self.path, exist_ok=True)
+
+    def add_config(
+        self, case_index: int, model_params: dict, context: dict = None
+    ) -> str:
+        """
+        Register the configuration of a test case, returns its digest. The
+        ``context`` (see ``run_context``) is part of the digest, so a rerun on
+        other data or with other salso arguments is not mixed up with this one.
+        """
+        digest = config_digest(model_params, context=context)
+        path = self._config_path(case_index)
+        if os.path.exists(path):
+            stored = self._load(path)
+            if stored["digest"] != digest:
+                raise ValueError(
+                    "Case {} of {} was run with a different configuration, data "
+                    "or salso arguments.".format(case_index, self.path)
+                )
+        else:
+            self._dump(
+                path, {"digest": digest, "config": model_params, "context": context}
+            )
+        return digest
+
+    def is_done(self, digest: str, week: int = None) -> bool:
+        return os.path.exists(self._unit_path(digest, week))
+
+    def save(self, digest: str, result: dict, week: int = None):
+        self._dump(self._unit_path(digest, week), result)
+
+    def load(self, digest: str, week: int = None) -> dict:
+        return self._load(self._unit_path(digest, week))
+
+    def posterior_dir(self, digest: str, week: int = None) -> str:
+        """Directory to spill the raw result of a unit to."""
+        name = "posterior" if week is None else "posterior-week-{:02d}".format(week)
+        return os.path.join(self.path, digest, name)
+
+    def load_posterior(self, digest: str, week: int = None) -> dict:
+        """Memory-mapped raw result of a unit, if it was spilled."""
+        return load_spilled(self.posterior_dir(digest, week))
+
+    def case_indices(self) -> list[int]:
+        return sorted(
+            int(name[len("config-") : -len(".pkl")])
+            for name in os.listdir(self.path)
+            if name.startswith("config-") and name.endswith(".pkl")
+        )
+
+    def yearly_performance(
+        self, case_index: int, weeks: list[int] = None
+    ) -> YearlyPerformance:
+        """
+        Result of a test case from its units: the given ``weeks`` of a weekly
+        model, or the yearly result if ``weeks`` is ``None``.
+        """
+        stored = self._load(self._config_path(case_index))
+        if weeks is None:
+            return YearlyPerformance(
+                config=stored["config"],
+                yearly_result_decomposed=self.load(stored["digest"]),
+            )
+        return YearlyPerformance(
+            config=stored["config"],
+            weekly_results=[self.load(stored["digest"], week) for week in weeks],
+        )
+
+    def model_performance(
+        self, name: str, weeks: list[int] = None, case_indices: list[int] = None
+    ) -> ModelPerformance:
+        """The test cases of the run (default: all), in the order of the grid."""
+        if case_indices is None:
+            case_indices = self.case_indices()
+        model_result = ModelPerformance(name=name)
+        for case_index in case_indices:
+            model_result.add_testcase(
+                yearly_result=self.yearly_performance(case_index, weeks=weeks),
+                case_index=case_index,
+            )
+        return model_result
+
+    def _config_path(self, case_index: int) -> str:
+        return os.path.join(self.path, "config-{:03d}.pkl".format(case_index))
+
+    def _unit_path(self, digest: str, week: int = None) -> str:
+        name = "year.pkl" if week is None else "week-{:02d}.pkl".format(week)
+        return os.path.join(self.path, digest, name)
+
+    @staticmethod
+    def _dump(path: str, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # a unit is either completely written or missing, even if the run dies
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as file:
+            pickle.dump(content, file)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _load(path: str):
+        with open(path, "rb") as file:
+            return pickle.load(file)
+
+
+def config_digest(model_params: dict, context: dict = None) -> str:
+    content = hashlib.sha256()
+    for name in sorted(model_params):
+        content.update(name.encode())
+        content.update(digest_value(model_params[name]))
+    for name in sorted(context or {}):
+        content.update("context:{}".format(name).encode())
+        content.update(digest_value(context[name]))
+    return content.hexdigest()[:16]
+
+
+def run_context(
+    data: pd.DataFrame, num_weeks: int, salso_args: dict, spatial: bool = True
+) -> dict:
+    """Everything besides the model parameters which changes a checkpointed unit."""
+    return {
+        "data": data_digest(data),
+        "num_weeks": num_weeks,
+        "salso_args": tuple(sorted(salso_args.items())),
+        "spatial": spatial,
+    }
+
+
+def data_digest(data: pd.DataFrame) -> str:
+    """Digest of the content of a data frame (year, variant, stations, ...)."""
+    content = hashlib.sha256(repr(list(data.columns)).encode())
+    content.update(pd.util.hash_pandas_object(data, index=True).values.tobytes())
+    return content.hexdigest()[:16]
+
+
+def spill_arrays(arrays, spill_dir: str) -> dict:
+    """
+    Write ``(name, values)`` pairs (e.g. the elements of an R result list) one by
+    one to ``{spill_dir}/{name}.npy`` and return them as read-only memory-mapped
+    arrays, so only one element is converted in memory at a time. Arrays which
+    are already mapped from a whole ``.npy`` file (e.g. a result cache entry) are
+    linked, or copied, instead of read. The directory is replaced as a whole
+    once all arrays are written.
+    """
+    tmp_dir = "{}.{}.tmp".format(spill_dir.rstrip(os.sep), os.getpid())
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    items = arrays.items() if isinstance(arrays, dict) else arrays
+    for name, values in items:
+        path = os.path.join(tmp_dir, "{}.npy".format(name))
+        if _is_npy_file(values):
+            try:
+                os.link(values.filename, path)
+            except OSError:
+                shutil.copyfile(values.filename, path)
+            continue
+        values = np.asarray(values)
+        mapped = open_memmap(
+            path,
+            mode="w+",
+            dtype=values.dtype,
+            shape=values.shape,
+        )
+        mapped[...] = values
+        mapped.flush()
+        del mapped
+    shutil.rmtree(spill_dir, ignore_errors=True)
+    os.replace(tmp_dir, spill_dir)
+    return load_spilled(spill_dir)
+
+
+def _is_npy_file(values) -> bool:
+    """Whether ``values`` is the complete array of a memory-mapped ``.npy``."""
+    if not isinstance(values, np.memmap) or values.filename is None:
+        return False
+    if not str(values.filename).endswith(".npy"):
+        return False
+    # views of a mapped array have the array as base, not the mapping
+    return isinstance(values.base, mmap.mmap) and len(values.base) == (
+        os.path.getsize(values.filename)
+    )
+
+
+def load_spilled(spill_dir: str) -> dict:
+    """
+    Arrays written by ``spill_arrays``, mapped lazily from disk. Small arrays
+    (e.g. lpml, waic) are read into memory, they are cheaper than a mapping.
+    """
+    arrays = {}
+    for name in sorted(os.listdir(spill_dir)):
+        if not name.endswith(".npy"):
+            continue
+        values = np.load(os.path.join(spill_dir, name), mmap_mode="r")
+        if values.nbytes <= small_array_bytes:
+            values = np.array(values)
+        arrays[name[: -len(".npy")]] = values
+    return arrays
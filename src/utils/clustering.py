@@ -1,4 +1,9 @@
+import itertools
+import logging
 import os
+import time
+from collections.abc import Mapping
+from concurrent.futures import Executor, as_completed
 from pathlib import Path
 
 import numpy as np
@@ -7,9 +12,35 @@ import rpy2.robjects as ro
 import rpy2.robjects.packages as rpackages
 from rpy2.robjects import pandas2ri
 
-from utils.magic import log_time
-from utils.models import Model
-from utils.results import Analyse, YearlyPerformance
+from utils.checkpoint import RunDirectory, config_digest, run_context, spill_arrays
+from utils.data_loader import CovariateCache, WeeklyPartitionedData, get_covariates
+from utils.diagnostics import (
+    AdaptiveRun,
+    MultiChain,
+    chain_diagnostics,
+    pool_chains,
+    scalar_traces,
+    summarize,
+    trace_fields,
+)
+from utils.magic import log_time, set_r_python_seed
+from utils.models import Model, get_analysis_fields
+from utils.parallel import default_n_workers, r_worker_pool
+from utils.result_cache import default_result_cache
+from utils.results import (
+    Analyse,
+    ModelPerformance,
+    YearlyPerformance,
+    salso_point_estimate,
+)
+from utils.scheduling import (
+    RuntimeModel,
+    estimate_makespan,
+    fit_features,
+    format_duration,
+    log_runtime,
+    longest_first,
+)
 
 drpm = rpackages.importr("drpm")
 ppmSuite = rpackages.importr("ppmSuite")
@@ -22,48 +53,623 @@ def yearly_evaluation(
     pm25_timeseries: np.ndarray,
     num_weeks: int,
     salso_args={"loss": "binder", "maxNCluster": 0},
+    weekly_data: WeeklyPartitionedData = None,
+    n_workers: int = 1,
+    spatial: bool = True,
+    run_dir: RunDirectory = None,
+    case_index: int = 0,
+    spill_posterior: bool = False,
+    use_cache: bool = False,
 ):
+    """
+    Evaluate one test case over the year. With a ``run_dir``, every completed
+    week (or the year for yearly models) is checkpointed there and units which
+    are already in it are loaded instead of fitted again. ``spill_posterior``
+    additionally keeps the raw MCMC output of every unit memory-mapped in the
+    run directory (see ``RunDirectory.load_posterior``). ``use_cache`` keeps the
+    fits in the persistent result cache (see ``Cluster.cluster``).
+    """
+    digest = None
+    if run_dir is not None:
+        context = run_context(data, num_weeks, salso_args, spatial=spatial)
+        digest = run_dir.add_config(case_index, model_params, context=context)
+
     if model.uses_weekly_data:
-        weekly_results = []
-        for week in range(1, num_weeks):
-            week_data = data[data["Week"] == week]
-
-            model_args = model_params | model.load_model_specific_data(week_data)
-            res_cluster, time_needed = Cluster.cluster(model=model.name, **model_args)
-            weekly_results.append(
-                Analyse.analyze_weekly_performance(
-                    py_res=res_cluster,
-                    target=week_data["log_pm25"],
-                    time_needed=time_needed,
-                    salso_args=salso_args,
-                )
-            )
+        if weekly_data is None:
+            weekly_data = WeeklyPartitionedData(data)
+        weekly_results = run_weekly_fits(
+            model=model,
+            model_params=model_params,
+            weekly_data=weekly_data,
+            weeks=list(range(1, num_weeks)),
+            salso_args=salso_args,
+            n_workers=n_workers,
+            run_dir=run_dir,
+            config_digest=digest,
+            spill_posterior=spill_posterior,
+            use_cache=use_cache,
+        )
         yearly_result = YearlyPerformance(
             config=model_params, weekly_results=weekly_results
         )
 
+    elif run_dir is not None and run_dir.is_done(digest):
+        yearly_result = YearlyPerformance(
+            config=model_params, yearly_result_decomposed=run_dir.load(digest)
+        )
+
     else:
         # use yearly data
         model_args = model_params | model.load_model_specific_data(
-            data=data, yearly_time_series=pm25_timeseries
+            data=data,
+            yearly_time_series=pm25_timeseries,
+            model_params=model_params,
+            spatial=spatial,
+        )
+        spill_dir = None
+        if run_dir is not None and spill_posterior:
+            spill_dir = run_dir.posterior_dir(digest)
+        res_cluster, time_needed = Cluster.cluster(
+            model=model.name,
+            use_cache=use_cache,
+            spill_dir=spill_dir,
+            fields=get_analysis_fields(model.name),
+            salso_args=salso_args,
+            **model_args,
         )
-        res_cluster, time_needed = Cluster.cluster(model=model.name, **model_args)
         yearly_result = YearlyPerformance(
             config=model_params,
-            yearly_result=Analyse.analyze_yearly_performance(
+            yearly_result_decomposed=Analyse.analyze_yearly_performance(
                 py_res=res_cluster,
                 target=pm25_timeseries,
                 time_needed=time_needed,
                 salso_args=salso_args,
             ),
         )
+        if run_dir is not None:
+            run_dir.save(digest, yearly_result.list_of_weekly)
     return yearly_result
 
 
+def run_grid(
+    model: Model,
+    data: pd.DataFrame,
+    pm25_timeseries: np.ndarray,
+    num_weeks: int,
+    salso_args={"loss": "binder", "maxNCluster": 0},
+    model_result: ModelPerformance = None,
+    n_workers: int = None,
+    seed: int = 123,
+    spatial: bool = True,
+    run_dir: RunDirectory = None,
+    spill_posterior: bool = False,
+    use_cache: bool = False,
+) -> ModelPerformance:
+    """
+    Evaluate all test cases of the hyperparameter grid of ``model``, spread over
+    a pool of R worker processes.
+
+    The number of workers is bounded by the cores and by the estimated memory
+    of one fit. Every finished case is added to ``model_result`` as soon as it
+    completes, at the position of its case in the grid, so the final table is
+    in grid order. Each case starts from the seed ``seed``, as in a serial run.
+    The cases are started in the order of their expected runtime (see
+    ``utils/scheduling.py``), longest first, and the expected duration of the
+    sweep is logged before it starts.
+
+    With a ``run_dir`` the sweep is checkpointed per week (or year) and resumes
+    from the completed units; the returned result is then read from ``run_dir``
+    so a resumed sweep gives the same table as an uninterrupted one, and the
+    raw MCMC output is kept memory-mapped there if ``spill_posterior`` is set.
+    The fits are only kept in the persistent result cache with ``use_cache``.
+    """
+    test_cases = list(model.yield_test_cases())
+    if model_result is None:
+        model_result = ModelPerformance(name=model.name)
+    if n_workers is None:
+        n_stations = data["IDStations"].nunique()
+        memory_per_case = max(
+            model.estimated_fit_memory(
+                model_params, n_stations=n_stations, n_timesteps=num_weeks
+            )
+            for model_params in test_cases
+        )
+        n_workers = default_n_workers(len(test_cases), memory_per_task=memory_per_case)
+    costs = expected_case_costs(
+        model,
+        test_cases,
+        data,
+        num_weeks,
+        salso_args=salso_args,
+        spatial=spatial,
+        run_dir=run_dir,
+    )
+    order = longest_first(costs)
+    logging.info(
+        "Running {} test cases of {} with {} workers, expected to take {}".format(
+            len(test_cases),
+            model.name,
+            n_workers,
+            format_duration(estimate_makespan(costs, n_workers)),
+        )
+    )
+
+    tasks = [
+        dict(
+            model=model,
+            model_params=model_params,
+            data=data,
+            pm25_timeseries=pm25_timeseries,
+            num_weeks=num_weeks,
+            salso_args=salso_args,
+            seed=seed,
+            spatial=spatial,
+            run_dir=run_dir,
+            case_index=case_index,
+            spill_posterior=spill_posterior,
+            use_cache=use_cache,
+        )
+        for case_index, model_params in enumerate(test_cases)
+    ]
+    if n_workers <= 1:
+        for case_index in order:
+            model_result.add_testcase(
+                yearly_result=evaluate_test_case(**tasks[case_index]),
+                case_index=case_index,
+            )
+            _log_case_done(case_index, len(tasks))
+    else:
+        with r_worker_pool(n_workers) as executor:
+            # the pool starts the submitted cases in order, i.e. longest first
+            futures = {
+                executor.submit(evaluate_test_case, **tasks[case_index]): case_index
+                for case_index in order
+            }
+            for future in as_completed(futures):
+                case_index = futures[future]
+                model_result.add_testcase(
+                    yearly_result=future.result(), case_index=case_index
+                )
+                _log_case_done(case_index, len(tasks))
+
+    if run_dir is None:
+        return model_result
+    return run_dir.model_performance(
+        name=model.name,
+        weeks=list(range(1, num_weeks)) if model.uses_weekly_data else None,
+        case_indices=list(range(len(tasks))),
+    )
+
+
+def expected_case_costs(
+    model: Model,
+    test_cases: list[dict],
+    data: pd.DataFrame,
+    num_weeks: int,
+    salso_args={"loss": "binder", "maxNCluster": 0},
+    spatial: bool = True,
+    run_dir: RunDirectory = None,
+) -> list[float]:
+    """
+    Expected runtime (s) of the test cases from the runtime log; units which
+    are already checkpointed in ``run_dir`` cost nothing.
+    """
+    runtimes = RuntimeModel.load()
+    n_stations = data["IDStations"].nunique()
+    weeks = list(range(1, num_weeks))
+    context = None
+    if run_dir is not None:
+        context = run_context(data, num_weeks, salso_args, spatial=spatial)
+    costs = []
+    for model_params in test_cases:
+        digest = None if run_dir is None else config_digest(model_params, context)
+        if model.uses_weekly_data:
+            features = fit_features(
+                model.name,
+                model_params,
+                n_stations=n_stations,
+                spatial=model.uses_coordinates(spatial),
+            )
+            n_open = sum(
+                run_dir is None or not run_dir.is_done(digest, week) for week in weeks
+            )
+            costs.append(n_open * runtimes.predict(features))
+        elif run_dir is not None and run_dir.is_done(digest):
+            costs.append(0.0)
+        else:
+            features = fit_features(
+                model.name,
+                model_params,
+                n_stations=n_stations,
+                n_timesteps=num_weeks,
+                spatial=model.uses_coordinates(spatial),
+            )
+            costs.append(runtimes.predict(features))
+    return costs
+
+
+def evaluate_test_case(
+    model: Model,
+    model_params: dict,
+    data: pd.DataFrame,
+    pm25_timeseries: np.ndarray,
+    num_weeks: int,
+    salso_args: dict,
+    seed: int = 123,
+    spatial: bool = True,
+    run_dir: RunDirectory = None,
+    case_index: int = 0,
+    spill_posterior: bool = False,
+    use_cache: bool = False,
+) -> YearlyPerformance:
+    """One test case of a grid, the weeks of weekly models are fit serially."""
+    set_r_python_seed(seed)
+    return yearly_evaluation(
+        model=model,
+        model_params=model_params,
+        data=data,
+        pm25_timeseries=pm25_timeseries,
+        num_weeks=num_weeks,
+        salso_args=salso_args,
+        n_workers=1,
+        spatial=spatial,
+        run_dir=run_dir,
+        case_index=case_index,
+        spill_posterior=spill_posterior,
+        use_cache=use_cache,
+    )
+
+
+def _log_case_done(case_index: int, n_cases: int):
+    logging.info("Finished case {}/{}".format(case_index + 1, n_cases))
+
+
+def run_weekly_fits(
+    model: Model,
+    model_params: dict,
+    weekly_data: WeeklyPartitionedData,
+    weeks: list[int],
+    salso_args={"loss": "binder", "maxNCluster": 0},
+    n_workers: int = None,
+    seed: int = 123,
+    covariate_cache: CovariateCache = None,
+    run_dir: RunDirectory = None,
+    config_digest: str = None,
+    spill_posterior: bool = False,
+    use_cache: bool = False,
+    executor: Executor = None,
+) -> list[dict]:
+    """
+    Fit and analyse the weeks independently, in a pool of worker processes (each
+    with its own R session) if ``n_workers`` > 1. The analysed weekly results
+    are returned in the order of ``weeks``.
+
+    The seeds of R and numpy are set to ``seed + week`` before every fit, so the
+    results do not depend on the number of workers. Covariates are taken from
+    ``covariate_cache`` if given, otherwise they are computed by the workers.
+    With a ``run_dir``, every finished week is saved under ``config_digest``
+    and weeks which are already there are not fitted again; ``spill_posterior``
+    keeps the raw output of the weeks memory-mapped next to them. With
+    ``use_cache`` the fits are kept in the persistent result cache.
+
+    With an ``executor`` (e.g. one ``r_worker_pool`` shared by all test cases of
+    a script), the weeks are submitted to it and ``n_workers`` is ignored.
+    """
+    if n_workers is None:
+        n_workers = default_n_workers(len(weeks))
+    uses_covariates = model.name == "gaussian_ppmx" and not model_params.get("PPM")
+    tasks = [
+        (
+            model,
+            model_params,
+            week,
+            weekly_data.week(week),
+            salso_args,
+            seed + week,
+            (
+                covariate_cache.r_frame(week)
+                if uses_covariates and covariate_cache is not None
+                else None
+            ),
+            (
+                run_dir.posterior_dir(config_digest, week)
+                if run_dir is not None and spill_posterior
+                else None
+            ),
+            use_cache,
+        )
+        for week in weeks
+        if run_dir is None or not run_dir.is_done(config_digest, week)
+    ]
+    results = {}
+
+    def finish(week: int, result: dict):
+        results[week] = result
+        if run_dir is not None:
+            run_dir.save(config_digest, result, week)
+
+    def submit_all(executor: Executor):
+        futures = {executor.submit(fit_week, *task): task[2] for task in tasks}
+        for future in as_completed(futures):
+            finish(futures[future], future.result())
+
+    if executor is not None:
+        submit_all(executor)
+    elif n_workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            finish(task[2], fit_week(*task))
+    else:
+        with r_worker_pool(n_workers) as executor:
+            submit_all(executor)
+    return [
+        results[week] if week in results else run_dir.load(config_digest, week)
+        for week in weeks
+    ]
+
+
+def fit_week(
+    model: Model,
+    model_params: dict,
+    week: int,
+    week_data: pd.DataFrame,
+    salso_args: dict,
+    seed: int,
+    covariates=None,
+    spill_dir: str = None,
+    use_cache: bool = False,
+) -> dict:
+    """Fit a weekly model to the data of one week and analyse the result."""
+    logging.info("Week {}".format(week))
+    set_r_python_seed(seed)
+    if (
+        covariates is None
+        and model.name == "gaussian_ppmx"
+        and not model_params.get("PPM")
+    ):
+        covariates = get_covariates(week_data, as_r_df=True, only_numerical=False)
+    model_args = model_params | model.load_model_specific_data(
+        week_data, covariates=covariates, model_params=model_params
+    )
+    res_cluster, time_needed = Cluster.cluster(
+        model=model.name,
+        use_cache=use_cache,
+        spill_dir=spill_dir,
+        fields=get_analysis_fields(model.name),
+        **model_args,
+    )
+    return Analyse.analyze_weekly_performance(
+        py_res=res_cluster,
+        target=week_data["log_pm25"],
+        time_needed=time_needed,
+        salso_args=salso_args,
+        model_name=model.name,
+    )
+
+
 class Cluster:
+    @staticmethod
+    def cluster(
+        model: str,
+        as_dict: bool = True,
+        use_cache: bool = False,
+        refresh_cache: bool = False,
+        spill_dir: str = None,
+        fields: list[str] = None,
+        salso_args: dict = None,
+        **kwargs,
+    ):
+        """
+        Fit a model and return the result with the time needed. By default the
+        result is a ``LazyResult`` which converts a field of the R result on its
+        first access. With ``use_cache``, result dicts are kept in the
+        persistent result cache: a fit with the same model, arguments, R random
+        state and package versions is not repeated but loaded, together with
+        the time the original fit needed. ``refresh_cache`` forces a refit.
+
+        With a ``spill_dir``, the arrays of the result dict are written to
+        memory-mapped ``.npy`` files there instead of being held in memory.
+        ``fields`` restricts the result to these elements of the R list (e.g.
+        ``get_analysis_fields(model)``), the others are never converted.
+        With ``salso_args``, the salso partition is estimated on the R draws of
+        Si before anything is converted, cached or spilled, and returned as
+        ``"partition"`` (not for adaptive or multi-chain runs, their partition
+        is estimated on the final or pooled Si).
+
+        If the arguments contain ``adaptive=AdaptiveRun(...)``, the number of
+        draws is chosen by ``Cluster.cluster_adaptive`` instead. With
+        ``chains=MultiChain(...)``, several chains are run by
+        ``Cluster.cluster_chains`` and pooled.
+        """
+        chains = kwargs.pop("chains", None)
+        if chains is not None and as_dict:
+            return Cluster.cluster_chains(
+                model=model,
+                chains=chains,
+                use_cache=use_cache,
+                refresh_cache=refresh_cache,
+                fields=fields,
+                **kwargs,
+            )
+        adaptive = kwargs.pop("adaptive", None)
+        if adaptive is not None and as_dict:
+            return Cluster.cluster_adaptive(
+                model=model,
+                adaptive=adaptive,
+                use_cache=use_cache,
+                refresh_cache=refresh_cache,
+                spill_dir=spill_dir,
+                fields=fields,
+                **kwargs,
+            )
+        if not as_dict:
+            return Cluster._fit(model=model, as_dict=False, **kwargs)
+        if not use_cache:
+            res, time_needed = Cluster._fit(
+                model=model,
+                spill_dir=spill_dir,
+                fields=fields,
+                lazy=True,
+                salso_args=salso_args,
+                **kwargs,
+            )
+            log_runtime(model, kwargs, time_needed)
+            return res, time_needed
+        cache = default_result_cache()
+        settings = {"__fields__": fields}
+        if salso_args is not None:
+            settings["__salso_args__"] = salso_args
+        key = cache.key(model, kwargs | settings)
+        if not refresh_cache:
+            cached = cache.get(key)
+            if cached is not None:
+                logging.info("Loaded {} result {} from the cache".format(model, key))
+                res, time_needed = cached
+                if spill_dir is not None:
+                    res = spill_arrays(res, spill_dir)
+                return res, time_needed
+        res, time_needed = Cluster._fit(
+            model=model,
+            spill_dir=spill_dir,
+            fields=fields,
+            salso_args=salso_args,
+            **kwargs,
+        )
+        log_runtime(model, kwargs, time_needed)
+        if spill_dir is None:
+            # a spilled result is already on disk, in the run directory
+            cache.put(key, res, time_needed)
+        return res, time_needed
+
+    @staticmethod
+    def cluster_adaptive(
+        model: str, adaptive: AdaptiveRun, fields: list[str] = None, **kwargs
+    ):
+        """
+        Fit with a growing number of draws until the scalar traces of the result
+        meet the ESS and split R-hat targets of ``adaptive`` or its budget is
+        used up. Every segment is a full run, the samplers cannot be continued.
+        The diagnostics of the last segment are stored in the result dict under
+        ``"diagnostics"``, the time is the sum over all segments.
+        """
+        requested = fields
+        if fields is not None:
+            fields = fields + [
+                name for name in trace_fields.get(model, []) if name not in fields
+            ]
+        total_time = 0
+        schedule = adaptive.schedule(
+            burn=kwargs.get("burn", 0), thin=kwargs.get("thin", 1)
+        )
+        for draws in schedule:
+            res, time_needed = Cluster.cluster(
+                model=model, fields=fields, **(kwargs | {"draws": draws})
+            )
+            total_time += time_needed
+            diagnostics = summarize(scalar_traces(model, res))
+            converged = adaptive.converged(diagnostics)
+            logging.info(
+                "{} with {} draws: min ESS {:.0f}, max R-hat {:.3f}".format(
+                    model,
+                    draws,
+                    min(values["ess"] for values in diagnostics.values()),
+                    max(values["rhat"] for values in diagnostics.values()),
+                )
+            )
+            if converged:
+                break
+        # the fields only needed for the traces are dropped again
+        res = {
+            name: res[name] for name in res if requested is None or name in requested
+        }
+        res["diagnostics"] = {
+            "draws": draws,
+            "converged": converged,
+            "traces": diagnostics,
+        }
+        return res, total_time
+
+    @staticmethod
+    def cluster_chains(
+        model: str, chains: MultiChain, fields: list[str] = None, **kwargs
+    ):
+        """
+        Run ``chains.n_chains`` chains of the same configuration in parallel
+        processes and pool their draws (e.g. Si for salso, fitted for the MSE).
+        The chains are seeded from the current numpy state, i.e. reproducibly
+        after ``set_r_python_seed``. The result contains the cross-chain
+        diagnostics under ``"diagnostics"``; the time is the wall time.
+        """
+        requested = fields
+        if fields is not None:
+            fields = fields + [
+                name for name in trace_fields.get(model, []) if name not in fields
+            ]
+        first_seed = int(np.random.randint(0, 2**31 - chains.n_chains))
+        tasks = [
+            (model, first_seed + chain, chains.salso_args, fields, kwargs)
+            for chain in range(chains.n_chains)
+        ]
+        n_workers = chains.n_workers
+        if n_workers is None:
+            n_workers = default_n_workers(chains.n_chains)
+
+        start = time.time()
+        if n_workers <= 1:
+            chain_results = [fit_chain(*task) for task in tasks]
+        else:
+            with r_worker_pool(n_workers) as executor:
+                chain_results = list(executor.map(fit_chain, *zip(*tasks)))
+        time_needed = time.time() - start
+
+        results = [res for res, _ in chain_results]
+        estimates = [estimate for _, estimate in chain_results]
+        res = pool_chains(model, results)
+        res = {
+            name: res[name] for name in res if requested is None or name in requested
+        }
+        res["diagnostics"] = chain_diagnostics(model, results, estimates)
+        if "diagnostics" in results[0]:
+            res["diagnostics"]["chains"] = [chain["diagnostics"] for chain in results]
+        logging.info(
+            "{} chains of {}: max R-hat {:.3f}, mean ARI of the chains {:.3f}".format(
+                chains.n_chains,
+                model,
+                max(values["rhat"] for values in res["diagnostics"]["traces"].values()),
+                res["diagnostics"]["mean_chain_ari"],
+            )
+        )
+        return res, time_needed
+
+    @staticmethod
+    def _fit(
+        model: str,
+        as_dict: bool = True,
+        spill_dir: str = None,
+        fields: list[str] = None,
+        lazy: bool = False,
+        salso_args: dict = None,
+        **kwargs,
+    ):
+        res, time_needed = Cluster._run(model, **kwargs)
+        if not as_dict:
+            return res, time_needed
+        extra = {}
+        if salso_args is not None:
+            # Si stays in R, the estimate is not part of the time of the fit
+            extra["partition"] = salso_point_estimate(
+                res.rx2("Si"), model, salso_args=salso_args
+            )
+        # conversion of the return types
+        start = time.time()
+        if lazy and spill_dir is None:
+            res = LazyResult(res, fields=fields, extra=extra)
+        else:
+            res = convert_to_dict(res, spill_dir=spill_dir, fields=fields, extra=extra)
+        return res, time_needed + time.time() - start
+
     @staticmethod
     @log_time(get_time=True)
-    def cluster(model: str, as_dict: bool = True, **kwargs):
+    def _run(model: str, **kwargs):
         if model == "sppm":
             # input shapes: Y = (n_stations,) , s_coords = (n_stations, 2)
             res = ppmSuite.sppm(**kwargs)
@@ -76,11 +682,77 @@ class Cluster:
             res = drpm.drpm_fit(**kwargs)
         else:
             raise NotImplementedError("Invalid choice of model.")
-        # conversion of the return types
-        if as_dict:
-            return convert_to_dict(res)
         return res
 
 
-def convert_to_dict(result: ro.vectors.ListVector) -> dict:
-    return {name: np.array(result[idx]) for idx, name in enumerate(result.names)}
+def fit_chain(
+    model: str, seed: int, salso_args: dict, fields: list[str], kwargs: dict
+) -> tuple[dict, np.ndarray]:
+    """One chain of a multi-chain run: its result and its salso partition."""
+    set_r_python_seed(seed)
+    res, _ = Cluster.cluster(model=model, fields=fields, **kwargs)
+    res = dict(res)
+    return res, salso_point_estimate(res["Si"], model, salso_args=salso_args)
+
+
+def convert_to_dict(
+    result: ro.vectors.ListVector,
+    spill_dir: str = None,
+    fields: list[str] = None,
+    extra: dict = None,
+) -> dict:
+    """
+    Numpy arrays of the elements of an R result list, only of ``fields`` if
+    given, and of the arrays in ``extra``. With a ``spill_dir`` they are written
+    to disk one by one and returned memory-mapped.
+    """
+    items = itertools.chain(
+        (
+            (name, result[idx])
+            for idx, name in enumerate(result.names)
+            if fields is None or name in fields
+        ),
+        (extra or {}).items(),
+    )
+    if spill_dir is not None:
+        return spill_arrays(items, spill_dir)
+    return {name: np.array(values) for name, values in items}
+
+
+class LazyResult(Mapping):
+    """
+    Read-only dict view of an R result list. A field is converted to numpy on
+    its first access and kept; fields outside of ``fields`` are not available.
+    The arrays in ``extra`` are added as fields.
+    """
+
+    def __init__(
+        self,
+        result: ro.vectors.ListVector,
+        fields: list[str] = None,
+        extra: dict = None,
+    ):
+        self._result = result
+        self._index = {
+            name: idx
+            for idx, name in enumerate(result.names)
+            if fields is None or name in fields
+        }
+        self._converted = dict(extra or {})
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        if name not in self._converted:
+            self._converted[name] = np.array(self._result[self._index[name]])
+        return self._converted[name]
+
+    def unconverted(self, name: str):
+        """The R object of a field, or its array if it was converted already."""
+        if name in self._converted:
+            return self._converted[name]
+        return self._result[self._index[name]]
+
+    def __iter__(self):
+        return iter(self._index | dict.fromkeys(self._converted))
+
+    def __len__(self) -> int:
+        return len(self._index | dict.fromkeys(self._converted))
@@ -1,16 +1,42 @@
+import hashlib
+import json
+import logging
 import os #importing the os module in Python. The os module provides a way of interacting with the operating system, and it is commonly used for tasks such as file and directory manipulation. In my script, it's used to perform file path operations with os.path.join at line 10
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
+import rpy2.rinterface as ri
 import rpy2.robjects as ro
 from rpy2.robjects import pandas2ri
 from rpy2.robjects.conversion import localconverter
 
+from utils.normalization import NormalizationStats
+
 data_path = os.path.join( # The os.path.join function is a part of the os module in Python and is used for joining one or more path components intelligently. This function concatenates various path components into a single path using the appropriate separator for the operating system. Here's a brief explanation of how it works: It takes multiple path components as arguments. It concatenates them using the appropriate separator for the operating system (e.g., "/" for Unix-like systems and "" for Windows). It returns the joined path as a single string.
     Path(__file__).parent.parent.parent, "data/dataset_{}_filled.csv"
 ) #data_path is a variable used to store the path to a CSV file. is defined as the result of joining different parts of a file path using os.path.join. Path(__file__): This gets the path of the current script file (so i get where data_loader is). __file__ is a special variable in Python that represents the path of the script. Path(__file__).parent: This gets the parent directory of the script file (so i get till utils). Path(__file__).parent.parent: This gets the parent directory of the parent directory of the script file (this is the path to src). Path(__file__).parent.parent.parent: This gets the parent directory of the parent directory of the parent directory of the script file (so i get the path for PM25-Clustering-main). "data/dataset_{}_filled.csv": This is a string representing the relative path to the CSV file. The {} is a placeholder for the year variable, which will be filled in later using the format method. os.path.join(...): This function joins the path components using the appropriate separator for the operating system ("/" for Unix-based systems and "" for Windows). So, the overall result is a file path pointing to a CSV file in a directory structure relative to the location of the script. The {} placeholder in the file name allows for dynamic filling of the year variable in the path. The purpose of the variable data_path is to make it easier to refer to the location of the dataset file throughout the script. It is created using the os.path.join function to concatenate different parts of the file path. Later in the script, this data_path is used with the pd.read_csv function to read the contents of the CSV file into a Pandas DataFrame:
 
+# variants of the yearly data in order of preference
+data_variants = ["filled", "cleaned", "raw"]
+data_path_variants = {
+    "filled": data_path,
+    "cleaned": data_path.replace("_filled", "_cleaned"),
+    "raw": data_path.replace("_filled", ""),
+}
+available_years = list(range(2016, 2022))
+
+# typed copies of the csv files, see load_cached_csv
+cache_dir = os.path.join(Path(__file__).parent.parent.parent, "data/.cache")
+# bump whenever _read_typed_csv changes the produced dtypes
+_cache_version = 1
+
+# columns used by every model: ids, coordinates, time and the target
+base_columns = ["IDStations", "Latitude", "Longitude", "Time", "Week", "log_pm25"]
+# columns which keep float64 in compact_frame
+full_precision_columns = ["Latitude", "Longitude", "log_pm25"]
+
 all_covariates = [
     "Latitude",
     "Longitude",
@@ -72,37 +98,258 @@ def get_numerical_covariates():
     return [x for x in all_covariates if x not in categorical_covariates]
 
 
-def load_data( #i call it at line 31 of the main 
-    year: int = 2019, #setting a default value for the int variable. we are considering the 2019 as year so if the year argument is not provided when calling the function, it will default to the value 2019.
-    week: int = None, # if the week argument is not provided when calling the function, it will default to None. when i firstly call the funtion in the main (line 31), i do not provide any input value so i will be considering 2019 for the year and none as week  
-) -> pd.DataFrame: #the expected return type for this function is a Pandas DataFrame 
-    data = pd.read_csv(data_path.format(year)) #data is a Pandas Data Frame. this line reads data from a CSV file specified by the data_path and year variables and stores it in a pandas DataFrame named data. i'm considering 2019. pd.read_csv: This is a function provided by the Pandas library for reading data from CSV (Comma-Separated Values) files. data_path.format(year): This uses the format method to insert the value of the year variable into the data_path string. It's a way to dynamically generate the file path based on the specified year. So, the line is essentially loading data from a CSV file whose path is determined by the data_path and the specified year, and it creates a Pandas DataFrame named data. 
-    for col in ordinal_categorical_covariates: #loop that iterates over each column specified in the ordinal_categorical_covariates list
+def load_cached_csv(
+    path: str,
+    use_cache: bool = True,
+    refresh_cache: bool = False,
+    columns: list[str] = None,
+) -> pd.DataFrame:
+    """
+    Read a csv through ``_read_typed_csv`` and keep the typed result in a parquet
+    file. The cache entry is keyed by the path, size and modification time of the
+    csv, i.e. it is invalidated automatically once the csv changes. If
+    ``columns`` is given, only these columns are read from the cache.
+    """
+    if not use_cache:
+        return _read_typed_csv(path, columns=columns)
+
+    cached_file = _cache_file_for(path)
+    if not refresh_cache and os.path.exists(cached_file):
+        return pd.read_parquet(cached_file, columns=columns)
+
+    data = _read_typed_csv(path)
+    _remove_stale_cache_files(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first: concurrent runs never read half a file
+    tmp_file = "{}.{}.tmp".format(cached_file, os.getpid())
+    data.to_parquet(tmp_file, index=False)
+    os.replace(tmp_file, cached_file)
+    logging.info("Cached typed data of {} in {}".format(path, cached_file))
+    if columns is not None:
+        return data[columns]
+    return data
+
+
+def clear_data_cache():
+    """Remove all cached data files."""
+    if not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        if name.endswith(".parquet"):
+            os.remove(os.path.join(cache_dir, name))
+
+
+def _cache_prefix(path: str) -> str:
+    path = os.path.abspath(path)
+    path_digest = hashlib.sha1(path.encode()).hexdigest()[:10]
+    return "{}-{}".format(Path(path).stem, path_digest)
+
+
+def _cache_file_for(path: str) -> str:
+    stat = os.stat(path)
+    key = "{}:{}:{}:{}".format(
+        os.path.abspath(path), stat.st_size, stat.st_mtime_ns, _cache_version
+    )
+    return os.path.join(
+        cache_dir,
+        "{}-{}.parquet".format(
+            _cache_prefix(path), hashlib.sha1(key.encode()).hexdigest()[:16]
+        ),
+    )
+
+
+def _remove_stale_cache_files(path: str):
+    if not os.path.isdir(cache_dir):
+        return
+    prefix = _cache_prefix(path) + "-"
+    for name in os.listdir(cache_dir):
+        if name.startswith(prefix) and name.endswith(".parquet"):
+            os.remove(os.path.join(cache_dir, name))
+
+
+def _read_typed_csv(path: str, columns: list[str] = None) -> pd.DataFrame:
+    """Parse one csv file and cast the categorical covariates and the time."""
+    data = pd.read_csv(path, usecols=columns) #data is a Pandas Data Frame. this line reads data from a CSV file specified by the data_path and year variables and stores it in a pandas DataFrame named data. i'm considering 2019. pd.read_csv: This is a function provided by the Pandas library for reading data from CSV (Comma-Separated Values) files. data_path.format(year): This uses the format method to insert the value of the year variable into the data_path string. It's a way to dynamically generate the file path based on the specified year. So, the line is essentially loading data from a CSV file whose path is determined by the data_path and the specified year, and it creates a Pandas DataFrame named data. 
+    for col in [c for c in ordinal_categorical_covariates if c in data.columns]: #loop that iterates over each column specified in the ordinal_categorical_covariates list
         data[col] = data[col].astype(str, copy=True) #For each column (col) in the DataFrame data, this line converts the data type of the values in that column to a string (str). The astype method is used for this conversion. The copy=True argument ensures that a new copy of the data is created rather than modifying the original data in place. This conversion to string may be necessary if the original data types in these columns are not strings, and there's a requirement to treat them as strings, possibly for consistency or compatibility with certain operations or analyses. Yes, the astype method is a built-in method in pandas, a popular data manipulation library for Python. The astype method is used to cast a pandas object (e.g., a column of a DataFrame) to a specified dtype. he term "cast" in the context of programming, and more specifically in the context of the astype method in pandas, refers to the act of changing the data type of an object from one type to another. Here, the astype method is used to cast (or convert) the values in the specified column (data[col]) to the string (str) data type. It means that each element in the column will be transformed into its string representation. So, the line of code is essentially saying: "Take the values in the specified column and convert them to strings."
     # transform non-numerical values into categorical values
-    for col_name in categorical_covariates: # to iterate over each column specified in the categorical_covariates list, and for each column, the data type of its values is changed to the categorical data type using the astype method.
+    for col_name in [c for c in categorical_covariates if c in data.columns]: # to iterate over each column specified in the categorical_covariates list, and for each column, the data type of its values is changed to the categorical data type using the astype method.
         data[col_name] = data[col_name].astype("category") # This part of the loop selects the values in the current column (data[col_name]) and uses the astype method to convert them to the categorical data type. The string "category" passed as an argument specifies the target data type. In the context of pandas, the data type "category" is used to represent categorical variables. Categorical variables are variables that can take on a limited, fixed set of values. it's written already in the documenation for the ppmsuite package that X is a data frame whose columns consist of covariates that will be incorporated in the partition model. Those with class of "character" or "factor" will be treated as categorical covariates. All others will be treated as continuous covariates
 
     # TODO: impute missing data
     # data = data.fillna(data.mode().iloc[0])  # not an appropriate solution
 
     # data = data.dropna(axis=0, how="any")
-    data["Time"] = pd.to_datetime(data["Time"]) #At the column Time in the dataset I have dates like 19/04/2019. This line converts the values in the "Time" column of the DataFrame data to datetime objects using the pd.to_datetime function. This function is a part of the pandas library and is used to convert argument to datetime. In this specific case, it's transforming the values in the "Time" column to datetime objects, assuming that the values in that column represent time or date information. This conversion can be useful for various time-based operations and analyses.
+    if "Time" in data.columns:
+        data["Time"] = pd.to_datetime(data["Time"]) #At the column Time in the dataset I have dates like 19/04/2019. This line converts the values in the "Time" column of the DataFrame data to datetime objects using the pd.to_datetime function. This function is a part of the pandas library and is used to convert argument to datetime. In this specific case, it's transforming the values in the "Time" column to datetime objects, assuming that the values in that column represent time or date information. This conversion can be useful for various time-based operations and analyses.
+    return data
+
+
+def load_data( #i call it at line 31 of the main 
+    year: int = 2019, #setting a default value for the int variable. we are considering the 2019 as year so if the year argument is not provided when calling the function, it will default to the value 2019.
+    week: int = None, # if the week argument is not provided when calling the function, it will default to None. when i firstly call the funtion in the main (line 31), i do not provide any input value so i will be considering 2019 for the year and none as week  
+    use_cache: bool = True,
+    refresh_cache: bool = False,
+    columns: list[str] = None,
+    compact: bool = False,
+) -> pd.DataFrame: #the expected return type for this function is a Pandas DataFrame 
+    """
+    Load the weekly Agrimonia data of one year with typed columns. The best
+    available variant of the year is used, see ``resolve_data_path``.
+
+    The typed frame is stored in a binary cache next to the data (see
+    ``load_cached_csv``), so only the first call after the csv changed parses it.
+    Use ``use_cache=False`` to bypass the cache and ``refresh_cache=True`` to
+    rebuild it.
+
+    ``columns`` restricts the loaded columns (see ``columns_for_model``) and
+    ``compact=True`` applies the memory saving dtypes of ``compact_frame``.
+    """
+    data = load_cached_csv(
+        resolve_data_path(year),
+        use_cache=use_cache,
+        refresh_cache=refresh_cache,
+        columns=columns,
+    )
+    if compact:
+        data = compact_frame(data)
 
     if week is not None: #at line 31 of the main i'm calling this function without input values so week will be equal to teh default value None 
         return data[data["Week"] == week]
     return data #i'm returning a pandas Data Frame where the categorical covariates are interpreted as "category". i need this word because the package ppmsuite is such that it treates as categorical covariates the ones with class of "category"
 
 
+def columns_for_model(model_name: str) -> list[str]:
+    """Columns needed to fit and evaluate a model (the map plots need more)."""
+    if model_name in ["sppm", "drpm"]:
+        return base_columns
+    elif model_name == "gaussian_ppmx":
+        return base_columns + [col for col in all_covariates if col not in base_columns]
+    else:
+        raise NotImplementedError
+
+
+def compact_frame(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Downcast the measurements to float32 (except the target and the coordinates),
+    the integer columns to the smallest integer type and store the station ids as
+    categorical, i.e. as small integer codes. Logs the memory saved.
+    """
+    memory_before = data.memory_usage(deep=True).sum()
+    data = data.copy()
+    for col in data.columns:
+        if col in full_precision_columns:
+            continue
+        if pd.api.types.is_float_dtype(data[col].dtype):
+            data[col] = data[col].astype(np.float32)
+        elif pd.api.types.is_integer_dtype(data[col].dtype):
+            data[col] = pd.to_numeric(data[col], downcast="integer")
+    if "IDStations" in data.columns:
+        data["IDStations"] = data["IDStations"].astype("category")
+
+    memory_after = data.memory_usage(deep=True).sum()
+    logging.info(
+        "Compact data: {:.2f} MB -> {:.2f} MB ({:.1f}% saved)".format(
+            memory_before / 1e6,
+            memory_after / 1e6,
+            100 * (1 - memory_after / memory_before),
+        )
+    )
+    return data
+
+
+def resolve_data_path(year: int, variants: list[str] = None) -> str:
+    """Path of the first existing variant (filled, cleaned, raw) of a year."""
+    if variants is None:
+        variants = data_variants
+    for variant in variants:
+        path = data_path_variants[variant].format(year)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(
+        "No data for year {} in the variants {}.".format(year, variants)
+    )
+
+
+def load_years(
+    years: list[int] = None,
+    variants: list[str] = None,
+    n_workers: int = None,
+    use_cache: bool = True,
+) -> pd.DataFrame:
+    """
+    Load several years into one frame with an additional ``Year`` column.
+
+    Parameters
+    ----------
+    years : list[int], optional
+        Years (or a range) to load, by default all years from 2016 to 2021.
+    variants : list[str], optional
+        Preferred data variants, by default filled, then cleaned, then raw.
+    n_workers : int, optional
+        Number of worker processes parsing the csv files in parallel, by
+        default one per year (bounded by the number of cores).
+    use_cache : bool, optional
+        Use the parquet cache of ``load_cached_csv``.
+
+    Returns
+    -------
+    pd.DataFrame
+        Data of all years, the categorical covariates share the same categories.
+    """
+    years = available_years if years is None else list(years)
+    paths = [resolve_data_path(year, variants=variants) for year in years]
+    if n_workers is None:
+        n_workers = min(len(paths), os.cpu_count() or 1)
+
+    if n_workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            frames = list(
+                executor.map(load_cached_csv, paths, [use_cache] * len(paths))
+            )
+    else:
+        frames = [load_cached_csv(path, use_cache=use_cache) for path in paths]
+
+    for year, frame in zip(years, frames):
+        # the filled files still contain the old index
+        frame.drop(
+            columns=[col for col in frame.columns if col.startswith("Unnamed")],
+            inplace=True,
+        )
+        frame["Year"] = year
+    _unify_categories(frames)
+    return pd.concat(frames, ignore_index=True)
+
+
+def _unify_categories(frames: list[pd.DataFrame]):
+    """Same categories for every categorical column, otherwise concat drops them."""
+    for col in categorical_covariates:
+        present = [frame for frame in frames if col in frame.columns]
+        categories = sorted(
+            set().union(*(frame[col].cat.categories for frame in present))
+        )
+        for frame in present:
+            frame[col] = frame[col].cat.set_categories(categories)
+
 def get_covariates(
     data: pd.DataFrame,
     normalize_numerical: bool = True,
     as_r_df: bool = True,
     ignore_cols: list[str] = None,
     only_numerical: bool = False,
+    stats: NormalizationStats = None,
+    year: int = None,
+    week: int = None,
 ):
+    """
+    Covariates of the data, optionally normalized. By default the statistics of
+    the given slice are used, pass ``stats`` (with the ``year``/``week`` the
+    slice belongs to) to normalize with precomputed statistics instead.
+    """
     if normalize_numerical:
-        data = _normalize_numerical_attributes(data, ignore_cols=ignore_cols)
+        data = _normalize_numerical_attributes(
+            data, ignore_cols=ignore_cols, stats=stats, year=year, week=week
+        )
     if only_numerical:
         data = data[get_numerical_covariates()]
 
@@ -112,32 +359,71 @@ def get_covariates(
 
 
 def _normalize_numerical_attributes(
-    data: pd.DataFrame, ignore_cols: list[str] = None
+    data: pd.DataFrame,
+    ignore_cols: list[str] = None,
+    stats: NormalizationStats = None,
+    year: int = None,
+    week: int = None,
 ) -> pd.DataFrame:
     """Mean zero and SD one for all numerical attributes"""
     data = data[all_covariates]
-    numerical_covariates = get_numerical_covariates()
-    data[numerical_covariates] = (
-        data[numerical_covariates] - data[numerical_covariates].mean()
-    ) / data[numerical_covariates].std()
+    if stats is not None:
+        data = stats.transform(data, year=year, week=week)
+    else:
+        numerical_covariates = get_numerical_covariates()
+        data[numerical_covariates] = (
+            data[numerical_covariates] - data[numerical_covariates].mean()
+        ) / data[numerical_covariates].std()
 
     if ignore_cols is not None:
-        data.drop(ignore_cols, inplace=True)
+        data = data.drop(columns=ignore_cols)
     return data
 
 
 def to_r_vector(data):
-    return ro.FloatVector(data)
+    return to_r_array(np.ravel(data))
+
 
 def to_r_int_vector(data):
-    return ro.IntVector(data)
+    return to_r_array(np.ravel(data), dtype=np.int32)
 
 
 def to_r_matrix(data: np.ndarray):
-    nrow, ncol = data.shape[0], data.shape[1]
-    # we need to flatten the vector and then reshape in R
-    data = data.flatten()
-    return ro.r["matrix"](ro.FloatVector(data), nrow=nrow, ncol=ncol)
+    data = np.asarray(data)
+    if data.ndim != 2:
+        raise ValueError("Expected a 2D array, got shape {}.".format(data.shape))
+    return to_r_array(data)
+
+
+def to_r_array(data: np.ndarray, dtype=np.float64):
+    """
+    Convert a numpy array of any dimension (vectors, matrices, the 3D Si arrays)
+    into the corresponding R vector/matrix/array.
+
+    R stores arrays column-major, so the data is laid out in Fortran order. This
+    needs at most one copy on the numpy side (none for Fortran contiguous input
+    of the right dtype) and a single memcpy of the buffer into R.
+    """
+    data = np.asfortranarray(data, dtype=dtype)
+    r_vec = _r_vector_from_buffer[dtype](memoryview(data.ravel(order="F")))
+    if data.ndim > 1:
+        r_vec.do_slot_assign("dim", ri.IntSexpVector(list(data.shape)))
+    return _r_array_class[(dtype, min(data.ndim, 3))](r_vec)
+
+
+_r_vector_from_buffer = {
+    np.float64: ri.FloatSexpVector.from_memoryview,
+    np.int32: ri.IntSexpVector.from_memoryview,
+}
+_r_array_class = {
+    (np.float64, 1): ro.vectors.FloatVector,
+    (np.float64, 2): ro.vectors.FloatMatrix,
+    (np.float64, 3): ro.vectors.FloatArray,
+    (np.int32, 1): ro.vectors.IntVector,
+    (np.int32, 2): ro.vectors.IntMatrix,
+    (np.int32, 3): ro.vectors.IntArray,
+}
+
 
 def r_NULL():
     return ro.NULL
@@ -179,42 +465,462 @@ def _get_types_of_cols(data: pd.DataFrame):
     return num_cols | cat_cols
 
 
-def yearly_data_as_timeseries(data): #I use this function in the main at line 32 after having just load the dataset into the dataframe data to create the pm25 time series. This function creates a time series matrix based on the input data which is a dataframe related to the year 2019 and wehre i'm considering the categorical covariates as "category". It first creates a dictionary (dict_stations) where each key is a station, and the corresponding value is a time series of weekly pm2.5 values for that station. Then, it uses another function _create_matrix_from_dict to convert this dictionary into a matrix. The resulting pm25_timeseries is a matrix where each row represents the weekly pm2.5 values of one station over the entire year, and each column represents the pm2.5 values of all stations for a specific week. _create_time_series(data_frame=data): This internal function creates a dictionary (dict_stations) where each key is a station, and the corresponding value is a time series of weekly pm2.5 values for that station. It extracts this information from the input DataFrame. _create_matrix_from_dict(dict_stations=dict_stations): This internal function converts the dictionary of time series into a matrix. Each row of the matrix represents the weekly pm2.5 values of one station over the entire year, and each column represents the pm2.5 values of all stations for a specific week. The resulting matrix is then returned. This function is designed to create a matrix representing a time series for weekly pm2.5 values across stations over the entire year.
+def yearly_data_as_timeseries(data: pd.DataFrame) -> np.ndarray:
     """
     Creates a matrix of shape (n_stations, n_timesteps) to have the full
     year as a time series, i.e. each row is the weekly pm2.5 value of ONE station
     over the entire year and each column represents the pm2.5 value of ALL stations
-    for a specific week.
+    for a specific week. Missing weeks are NaN.
+    """
+    tensor = station_week_tensor(data, columns=["log_pm25"])
+    if tensor.mask["log_pm25"].any():
+        logging.warning(
+            "{} station-weeks without a log_pm25 value are NaN.".format(
+                tensor.mask["log_pm25"].sum()
+            )
+        )
+    return tensor.values["log_pm25"]
+
+
+class StationWeekTensor:
+    """
+    Values of several columns on the grid of stations (rows) and weeks (cols).
+
+    ``values[col]`` has shape (n_stations, n_weeks), ``mask[col]`` is True
+    wherever the station has no (or a NaN) value in that week. The rows follow
+    ``stations`` (order of first appearance in the data) and the columns follow
+    the sorted ``weeks``.
+    """
+
+    def __init__(
+        self,
+        values: dict[str, np.ndarray],
+        mask: dict[str, np.ndarray],
+        stations: np.ndarray,
+        weeks: np.ndarray,
+    ):
+        self.values = values
+        self.mask = mask
+        self.stations = stations
+        self.weeks = weeks
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return (self.stations.shape[0], self.weeks.shape[0])
+
+    def __getitem__(self, col: str) -> np.ndarray:
+        return self.values[col]
+
+
+def station_week_tensor(
+    data: pd.DataFrame, columns: list[str] = None
+) -> StationWeekTensor:
     """
-    dict_stations = _create_time_series(data_frame=data) #i'm passing to the function _create_time_series the dataset loaded at line 31 which is related to the year 2019, wthout a selected week and for which we have signed the categorical variables as "category". dict_stations is a dictionary where keys are station identifiers, and values are time series data for the corresponding station. Here's what happens in _create_time_series: It identifies unique station identifiers in the DataFrame. For each station, it selects data related to that station. It creates a time series (log_pm25_series) by setting the "Week" column as the index. The time series is stored in a dictionary (dict_stations) with the station identifier as the key. So, after the execution of dict_stations = _create_time_series(data_frame=data), dict_stations will be a dictionary containing time series data for each station in the data DataFrame. 
-    return _create_matrix_from_dict(dict_stations=dict_stations) # I'm transform the original DataFrame into a matrix format suitable for time series analysis, where each row represents a station, and each column represents a week with corresponding pm2.5 values.
+    Scatter the rows of ``data`` into (n_stations, n_weeks) matrices in a single
+    pass. Categorical columns are stored as their category codes.
+    """
+    if columns is None:
+        columns = ["log_pm25"]
+    station_idx, stations = pd.factorize(data["IDStations"], sort=False)
+    week_idx, weeks = pd.factorize(data["Week"], sort=True)
+    shape = (stations.shape[0], weeks.shape[0])
+
+    values, mask = {}, {}
+    for col in columns:
+        if isinstance(data[col].dtype, pd.CategoricalDtype):
+            col_values = data[col].cat.codes.to_numpy(dtype=float)
+            col_values[col_values < 0] = np.nan
+        else:
+            col_values = data[col].to_numpy(dtype=float)
+        matrix = np.full(shape, np.nan)
+        matrix[station_idx, week_idx] = col_values
+        values[col] = matrix
+        mask[col] = np.isnan(matrix)
+
+    return StationWeekTensor(
+        values=values,
+        mask=mask,
+        stations=np.asarray(stations),
+        weeks=np.asarray(weeks),
+    )
+
+
+class WeeklyPartitionedData:
+    """
+    The data of one year sorted by week with the row offsets of every week, so
+    the weekly models get their slice without scanning the full frame.
+
+    ``week(w)`` returns the rows of week ``w`` as a frame, ``y``, ``coords`` and
+    ``covariates`` the corresponding numpy arrays. Iterating yields the tuples
+    ``(week, week_data)`` in increasing week order.
+    """
+
+    def __init__(self, data: pd.DataFrame):
+        order = np.argsort(data["Week"].to_numpy(), kind="stable")
+        self.data = data.iloc[order]
+        sorted_weeks = self.data["Week"].to_numpy()
+        self.weeks, starts = np.unique(sorted_weeks, return_index=True)
+        self._offsets = np.append(starts, sorted_weeks.shape[0])
+        self._position = {week: idx for idx, week in enumerate(self.weeks.tolist())}
+
+        self.covariate_names = [
+            col for col in all_covariates if col in self.data.columns
+        ]
+        self._y = self.data["log_pm25"].to_numpy(dtype=float)
+        self._coords = self.data[["Latitude", "Longitude"]].to_numpy(dtype=float)
+        self._covariates = np.column_stack(
+            [
+                (
+                    self.data[col].cat.codes.to_numpy(dtype=float)
+                    if isinstance(self.data[col].dtype, pd.CategoricalDtype)
+                    else self.data[col].to_numpy(dtype=float)
+                )
+                for col in self.covariate_names
+            ]
+        )
+
+    def rows(self, week: int) -> slice:
+        """Positions of the rows of one week in ``self.data``."""
+        idx = self._position[week]
+        return slice(self._offsets[idx], self._offsets[idx + 1])
+
+    def week(self, week: int) -> pd.DataFrame:
+        return self.data.iloc[self.rows(week)]
+
+    def y(self, week: int) -> np.ndarray:
+        return self._y[self.rows(week)]
+
+    def coords(self, week: int) -> np.ndarray:
+        """Latitude and longitude of the stations, shape (n_stations, 2)."""
+        return self._coords[self.rows(week)]
+
+    def covariates(self, week: int) -> np.ndarray:
+        """Covariates (categorical ones as codes), columns ``covariate_names``."""
+        return self._covariates[self.rows(week)]
+
+    def __len__(self) -> int:
+        return self.weeks.shape[0]
+
+    def __iter__(self):
+        for week in self.weeks.tolist():
+            yield week, self.week(week)
+
+
+class CovariateCache:
+    """
+    Covariates of every week as pandas frame, R data.frame and numpy array.
+
+    The covariates only depend on the week and the normalization settings, so
+    they are computed once and reused for every configuration of a
+    hyperparameter grid. Entries are keyed by year, week, column set and the
+    options of ``get_covariates``.
 
+    With ``stats`` the numerical covariates are normalized by the precomputed
+    statistics (of the week, the year or all data, depending on their scope);
+    the weeks of this data are merged into them once.
+    """
+
+    def __init__(
+        self,
+        weekly_data: WeeklyPartitionedData,
+        year: int = None,
+        stats: NormalizationStats = None,
+    ):
+        self.weekly_data = weekly_data
+        if year is None:
+            year = int(weekly_data.data["Time"].dt.year.mode().iloc[0])
+        self.year = year
+        self.stats = stats
+        if stats is not None:
+            stats.update_from_frame(weekly_data.data, year=year)
+        self._frames: dict[tuple, pd.DataFrame] = {}
+        self._r_frames: dict[tuple, ro.DataFrame] = {}
+        self._arrays: dict[tuple, np.ndarray] = {}
+
+    def _key(
+        self,
+        week: int,
+        normalize_numerical: bool,
+        ignore_cols: list[str],
+        only_numerical: bool,
+    ) -> tuple:
+        return (
+            self.year,
+            week,
+            tuple(self.weekly_data.covariate_names),
+            normalize_numerical,
+            tuple(ignore_cols) if ignore_cols is not None else None,
+            only_numerical,
+            self.stats.scope if self.stats is not None else None,
+        )
+
+    def frame(
+        self,
+        week: int,
+        normalize_numerical: bool = True,
+        ignore_cols: list[str] = None,
+        only_numerical: bool = False,
+    ) -> pd.DataFrame:
+        key = self._key(week, normalize_numerical, ignore_cols, only_numerical)
+        if key not in self._frames:
+            week_data = self.weekly_data.week(week)
+            self._frames[key] = get_covariates(
+                week_data[self.weekly_data.covariate_names].copy(),
+                normalize_numerical=normalize_numerical,
+                as_r_df=False,
+                ignore_cols=ignore_cols,
+                only_numerical=only_numerical,
+                stats=self.stats,
+                year=self.year,
+                week=week,
+            )
+        return self._frames[key]
+
+    def r_frame(self, week: int, **options) -> ro.DataFrame:
+        """R data.frame as passed to gaussian_ppmx, see ``to_r_dataframe``."""
+        key = self._key(week, **self._with_defaults(options))
+        if key not in self._r_frames:
+            self._r_frames[key] = to_r_dataframe(self.frame(week, **options))
+        return self._r_frames[key]
+
+    def array(self, week: int, **options) -> np.ndarray:
+        """Covariates as float matrix, categorical covariates as their codes."""
+        key = self._key(week, **self._with_defaults(options))
+        if key not in self._arrays:
+            frame = self.frame(week, **options)
+            self._arrays[key] = np.column_stack(
+                [
+                    (
+                        frame[col].cat.codes.to_numpy(dtype=float)
+                        if isinstance(frame[col].dtype, pd.CategoricalDtype)
+                        else frame[col].to_numpy(dtype=float)
+                    )
+                    for col in frame.columns
+                ]
+            )
+        return self._arrays[key]
+
+    def fill(self, weeks: list[int] = None, as_r_df: bool = True, **options):
+        """Compute the covariates of all (or the given) weeks up front."""
+        if weeks is None:
+            weeks = self.weekly_data.weeks.tolist()
+        for week in weeks:
+            if as_r_df:
+                self.r_frame(week, **options)
+            else:
+                self.array(week, **options)
+
+    @staticmethod
+    def _with_defaults(options: dict) -> dict:
+        return {
+            "normalize_numerical": options.get("normalize_numerical", True),
+            "ignore_cols": options.get("ignore_cols"),
+            "only_numerical": options.get("only_numerical", False),
+        }
+
+
+# preprocessing of the raw Agrimonia files into the cleaned/filled variants
+covariates_to_drop = ["AQ_co", "AQ_nh3", "AQ_so2", "LA_soil_use"]
+# stations with more missing weeks in one of these covariates are dropped
+fill_checked_covariates = ["AQ_pm10", "AQ_nox", "AQ_no2", "LI_pigs", "LI_bovine"]
+max_missing_weeks = 24
+preprocessing_manifest = os.path.join(
+    Path(__file__).parent.parent.parent, "data/.preprocessing.json"
+)
+# bump whenever the preprocessing changes its output
+_preprocessing_version = 1
+
+
+def week_of_year(time: pd.Series) -> pd.Series:
+    """
+    Week number counted from January 1st, i.e. (day of year - 1) // 7 + 1,
+    where the last day of a year (the last two of a leap year) belong to week
+    52, so every year has exactly 52 weeks.
 
-def _create_time_series(data_frame): #I'm giving as input the dataset that i have loaded. the output of this function will be a dictionary. stations = data_frame["IDStations"].unique(): It extracts unique station IDs from the "IDStations" column in the DataFrame. dict_stations = {}: Initializes an empty dictionary to store time series data for each station. The function then iterates over each station, selects the data for that station, and creates a time series for the "log_pm25" values indexed by the "Week" column. This time series is added to the dict_stations dictionary, where the station ID is the key. Finally, the function returns the dictionary containing time series data for each station.
-    stations = data_frame["IDStations"].unique() #extracting the unique values from the "IDStations" column of the given DataFrame (data_frame). This line is used to identify the unique station IDs in the dataset. data_frame["IDStations"]: This part retrieves the "IDStations" column from the DataFrame. .unique(): This method returns an array of unique values present in the specified column. So, the stations variable will contain an array of unique station IDs found in the "IDStations" column of the DataFrame. The .unique() method is a pandas method used on a pandas Series (column) object. It returns an array containing unique values from the Series.
+    Contrary to the ISO week the first days of January never belong to the last
+    week of the previous year (the week-53 issue of the 2021 data).
+    """
+    return np.minimum((time.dt.dayofyear - 1) // 7 + 1, 52).astype(int)
 
-    dict_stations = {}  # stations -> time series. This line initializes an empty dictionary named dict_stations. This dictionary will be used to store time series data for each station. The keys of the dictionary will be station IDs, and the corresponding values will be time series data for the "log_pm25" values of that station over time.
-    for station in stations: #I recall that stations is an array containing the unique IDStations. loop that iterates over each unique station ID in the stations array. The stations array is obtained by extracting unique values from the "IDStations" column of the DataFrame. This loop processes each station one by one.
-        # Select data for current station
-        data_station = data_frame[data_frame["IDStations"] == station] #This line creates a new DataFrame data_station by filtering rows from the original DataFrame (data_frame) where the "IDStations" column is equal to the current station value. It essentially isolates the data related to a specific station for further processing within the loop. so, inside data_station, i'm consideirng one single station
 
-        # Crea una time series per la stazione corrente
-        log_pm25_series = data_station.set_index("Week")["log_pm25"] #a time series (log_pm25_series) for a specific station by setting the "Week" column as the index of the data_station DataFrame and then selecting the "log_pm25" column. The resulting log_pm25_series represents the weekly values of the "log_pm25" variable for a particular station. A time series is a sequence of data points, typically ordered by time. In this context, the time series (log_pm25_series) is a one-dimensional array-like structure that represents the weekly values of the "log_pm25" variable for a specific station. It is created by setting the "Week" column as the index of the data_station DataFrame and then extracting the values from the "log_pm25" column. Each value in the time series corresponds to a specific week, forming a sequence of data points over time. Setting the "Week" column as the index means making the "Week" column the primary reference for the rows in the DataFrame. The values in the "Week" column will become the row labels, and the DataFrame will be organized based on these values.So, log_pm25_series becomes a Pandas Series where the index is the "Week" values, and the values are from the "log_pm25" column. It essentially extracts a time series of the "log_pm25" values for a specific station.
+def preprocess_years(
+    years: list[int] = None,
+    force: bool = False,
+    chunksize: int = 50_000,
+    output_dir: str = None,
+) -> list[int]:
+    """
+    Create the cleaned and filled variants of the raw yearly data.
+
+    Only years whose raw file changed since the last run (or whose outputs are
+    missing) are processed, see ``preprocessing_manifest``. Existing outputs
+    which were not written by this function (e.g. the shipped files in
+    ``data/``) are only overwritten with ``force``, otherwise the year is
+    skipped.
+
+    Parameters
+    ----------
+    years : list[int], optional
+        Years to process, by default all years from 2016 to 2021.
+    force : bool, optional
+        Process the years even if their raw data did not change, and overwrite
+        outputs which were not produced by this function.
+    chunksize : int, optional
+        Number of raw rows read at once.
+    output_dir : str, optional
+        Directory of the outputs, by default next to the raw data.
+
+    Returns
+    -------
+    list[int]
+        The years which were processed.
+    """
+    years = available_years if years is None else list(years)
+    manifest = {}
+    if os.path.exists(preprocessing_manifest):
+        with open(preprocessing_manifest) as file:
+            manifest = json.load(file)
+
+    processed = []
+    for year in years:
+        raw_path = data_path_variants["raw"].format(year)
+        outputs = {
+            variant: _output_path(data_path_variants[variant], year, output_dir)
+            for variant in ["cleaned", "filled"]
+        }
+        stat = os.stat(raw_path)
+        fingerprint = {
+            "source": os.path.abspath(raw_path),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "version": _preprocessing_version,
+            "outputs": outputs,
+        }
+        up_to_date = manifest.get(str(year)) == fingerprint and all(
+            os.path.exists(path) for path in outputs.values()
+        )
+        if up_to_date and not force:
+            logging.info("Preprocessed data of {} is up to date.".format(year))
+            continue
+        produced = manifest.get(str(year), {}).get("outputs", {}).values()
+        foreign = [
+            path
+            for path in outputs.values()
+            if os.path.exists(path) and path not in produced
+        ]
+        if foreign and not force:
+            logging.warning(
+                "Skipped {}: {} not produced by preprocess_years, use force=True "
+                "or another output_dir to replace.".format(year, ", ".join(foreign))
+            )
+            continue
+
+        weekly = aggregate_weekly(raw_path, chunksize=chunksize)
+        cleaned = clean_weekly_data(weekly)
+        filled = fill_weekly_data(cleaned)
+        cleaned.to_csv(outputs["cleaned"], index=False)
+        filled.to_csv(outputs["filled"], index=False)
+        logging.info(
+            "Preprocessed {}: {} stations cleaned, {} stations filled.".format(
+                year, cleaned["IDStations"].nunique(), filled["IDStations"].nunique()
+            )
+        )
+
+        manifest[str(year)] = fingerprint
+        processed.append(year)
+
+    os.makedirs(os.path.dirname(preprocessing_manifest), exist_ok=True)
+    with open(preprocessing_manifest, "w") as file:
+        json.dump(manifest, file, indent=2)
+    return processed
+
+
+def aggregate_weekly(path: str, chunksize: int = 50_000) -> pd.DataFrame:
+    """
+    Aggregate a raw (daily or weekly) csv to one row per station and week.
 
-        # Aggiungi la time series al dizionario
-        dict_stations[station] = log_pm25_series #adding a new key-value pair to the dict_stations dictionary. The station is used as the key, and log_pm25_series is the corresponding value. Here's what it does in the context of your code: station: It represents a unique identifier for a particular station. log_pm25_series: It represents the time series of log-transformed PM2.5 values for the given station over different weeks. So, the dictionary dict_stations is being populated with entries where each station is associated with its respective time series of PM2.5 values. For example, if station_1 is a key in dict_stations, dict_stations[station_1] would give you the time series of log-transformed PM2.5 values for that specific station. 
-    return dict_stations #dictionary that contains the time series data for each station. When you call this function, you would get a dictionary where each key is a station identifier, and the corresponding value is the time series of log-transformed PM2.5 values for that station
+    The file is read in chunks, each chunk is reduced to sums and counts of the
+    numerical columns and value counts of the categorical ones, so the memory
+    needed does not depend on the size of the file. Numerical values are
+    averaged, categorical ones take the most frequent value of the week.
+    """
+    keys = ["IDStations", "Week"]
+    sums, counts, category_counts, times = [], [], {}, []
+    for chunk in pd.read_csv(path, chunksize=chunksize, dtype={"IDStations": str}):
+        chunk["Time"] = pd.to_datetime(chunk["Time"])
+        chunk["Week"] = week_of_year(chunk["Time"])
+        numerical = [
+            col
+            for col in chunk.columns
+            if col not in keys + ["Time"] + categorical_covariates
+        ]
+        grouped = chunk.groupby(keys)
+        sums.append(grouped[numerical].sum(min_count=1))
+        counts.append(grouped[numerical].count())
+        times.append(grouped["Time"].min())
+        for col in [c for c in categorical_covariates if c in chunk.columns]:
+            category_counts.setdefault(col, []).append(
+                chunk.groupby(keys + [col]).size()
+            )
+
+    group_sum = pd.concat(sums).groupby(level=keys).sum(min_count=1)
+    group_count = pd.concat(counts).groupby(level=keys).sum()
+    weekly = group_sum / group_count.where(group_count > 0)
+    weekly["Time"] = pd.concat(times).groupby(level=keys).min()
+    for col, col_counts in category_counts.items():
+        col_counts = pd.concat(col_counts).groupby(level=keys + [col]).sum()
+        # most frequent category per station and week
+        weekly[col] = (
+            col_counts.sort_values(ascending=False, kind="stable")
+            .reset_index(level=col)
+            .groupby(level=keys)[col]
+            .first()
+        )
+
+    weekly = weekly.reset_index()
+    weekly["Time"] = weekly["Time"].dt.strftime("%Y-%m-%d")
+    raw_columns = pd.read_csv(path, nrows=0).columns.tolist()
+    return weekly[[col for col in raw_columns if col != "Week"] + ["Week"]]
+
+
+def clean_weekly_data(weekly: pd.DataFrame) -> pd.DataFrame:
+    """
+    Keep only stations with a pm2.5 value in every week and add log(pm2.5 + 1).
+    """
+    weekly = weekly.dropna(subset=["AQ_pm25"])
+    n_weeks = weekly["Week"].nunique()
+    station_counts = weekly["IDStations"].value_counts()
+    complete = station_counts[station_counts == n_weeks].index
+    cleaned = weekly[weekly["IDStations"].isin(complete)].copy()
+    cleaned.insert(len(cleaned.columns) - 1, "log_pm25", np.log(cleaned["AQ_pm25"] + 1))
+    return cleaned.reset_index(drop=True)
 
 
-def _create_matrix_from_dict(dict_stations): #_create_matrix_from_dict(dict_stations): This function takes the dictionary dict_stations (created by _create_time_series) as input. It determines the number of stations (num_stations) and the maximum length of time series (max_length) among all stations. Initializes a matrix (matrix) with zeros, where each row represents the pm2.5 values for a station, and each column represents a week. The function then fills the matrix with the corresponding log_pm25 values from each station's time series. The resulting matrix is returned.
-    """Create a matrix where each row is the pm2.5 value for a station over one year."""
-    # Obtain number of stations and max length of time series
-    num_stations = len(dict_stations)
-    max_length = max(len(series) for series in dict_stations.values())
-    matrix = np.zeros((num_stations, max_length))
+def fill_weekly_data(cleaned: pd.DataFrame) -> pd.DataFrame:
+    """
+    Drop the unused covariates and the stations with more than
+    ``max_missing_weeks`` missing weeks in one of ``fill_checked_covariates``.
+    The remaining gaps are interpolated linearly along the weeks of a station.
+    """
+    filled = cleaned.drop(
+        columns=[col for col in covariates_to_drop if col in cleaned.columns]
+    )
+    missing = filled[fill_checked_covariates].isna().groupby(filled["IDStations"]).sum()
+    too_many_missing = missing.index[(missing > max_missing_weeks).any(axis=1)]
+    filled = filled[~filled["IDStations"].isin(too_many_missing)]
+    filled = filled.sort_values(["IDStations", "Week"], kind="stable")
+
+    numerical = [
+        col for col in filled.columns if pd.api.types.is_float_dtype(filled[col].dtype)
+    ]
+    filled[numerical] = filled.groupby("IDStations")[numerical].transform(
+        lambda series: series.interpolate(limit_direction="both")
+    )
+    return filled.reset_index(drop=True)
 
-    # Put log_pm25 values into matrix
-    for idx, series in enumerate(dict_stations.values()): #This line is iterating over the values of the dict_stations dictionary, where each value is a time series for a specific station. The enumerate function is used to get both the index (idx) and the actual series for each iteration. For each station, it's taking the log-transformed PM2.5 values from the series and placing them in the corresponding row of the matrix. The matrix is a 2D NumPy array where each row represents a station, and each column represents a time step in the time series. The length of each series determines how many columns are filled for each row in the matrix. In summary, this line populates a 2D matrix with log-transformed PM2.5 values for each station over the course of the year. The length of each series might be different, but the matrix is structured to accommodate the longest time series.
-        matrix[idx, : len(series)] = series.values #assigning the values of a time series (series.values) to a specific row (matrix[idx, ...]) in a 2D NumPy array (matrix). Let's break it down: idx: This is the index of the current time series in the iteration. matrix[idx, ...]: This selects the row in the matrix corresponding to the current index (idx). : len(series)]: This selects a portion of the row, specifically the first len(series) elements. It ensures that only the relevant portion of the row is assigned values from the time series. = series.values: This assigns the values of the time series to the selected portion of the row in the matrix. In simpler terms, this line is filling a row in the matrix with values from a time series, making sure to only fill the part of the row that corresponds to the length of the time series. The resulting matrix represents the PM2.5 values for different stations over time.
 
-    return matrix
+def _output_path(template: str, year: int, output_dir: str = None) -> str:
+    path = template.format(year)
+    if output_dir is None:
+        return path
+    return os.path.join(output_dir, os.path.basename(path))
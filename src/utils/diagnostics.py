@@ -0,0 +1,280 @@
+from itertools import combinations
+
+import numpy as np
+from sklearn.metrics import adjusted_rand_score
+
+"""
+Convergence diagnostics of the MCMC output: effective sample size and split R-hat
+(Gelman et al., Bayesian Data Analysis, 3rd ed.) of scalar traces, the settings
+of adaptive runs which grow the number of draws until they are met, and pooling
+and agreement of several chains of the same configuration.
+"""
+
+# result fields the scalar traces are computed from, in addition to Si
+trace_fields = {
+    "sppm": ["like"],
+    "gaussian_ppmx": ["like"],
+    "drpm": ["llike", "phi0", "lam2", "alpha"],
+}
+
+
+class AdaptiveRun:
+    """
+    Settings of an adaptive run, passed to a model as ``adaptive=AdaptiveRun()``.
+
+    The samplers cannot be continued from their last state, so every segment is
+    a new run with ``growth`` times the draws of the previous one. The first one
+    has at least ``initial_draws`` draws and keeps at least ``min_ess`` draws
+    after ``burn`` and ``thin``, fewer could not meet the target. The run stops
+    once every scalar trace has an effective sample size of at least
+    ``min_ess`` and a split R-hat of at most ``max_rhat``, or when the next
+    segment would exceed the budget. ``max_draws`` is the budget of all
+    segments together: a restart costs all its draws again, so an unconverged
+    run costs the sum of its segments, not only the last one. ``burn`` and
+    ``thin`` are taken from the model parameters.
+    """
+
+    def __init__(
+        self,
+        min_ess: float = 400,
+        max_rhat: float = 1.01,
+        initial_draws: int = 2000,
+        max_draws: int = 50000,
+        growth: float = 2,
+    ):
+        self.min_ess = min_ess
+        self.max_rhat = max_rhat
+        self.initial_draws = initial_draws
+        self.max_draws = max_draws
+        self.growth = growth
+
+    def schedule(self, burn: int = 0, thin: int = 1) -> list[int]:
+        """
+        Number of draws of the segments, together at most ``max_draws``. The
+        last segment takes the rest of the budget if that is still more than
+        the one before.
+        """
+        first = max(
+            self.initial_draws, burn + max(1, thin) * int(np.ceil(self.min_ess))
+        )
+        draws = [min(first, max(self.max_draws, burn + 1))]
+        while True:
+            remaining = self.max_draws - sum(draws)
+            next_draws = min(remaining, int(draws[-1] * self.growth))
+            if next_draws <= draws[-1]:
+                return draws
+            draws.append(next_draws)
+
+    def converged(self, diagnostics: dict) -> bool:
+        return all(
+            values["ess"] >= self.min_ess and values["rhat"] <= self.max_rhat
+            for values in diagnostics.values()
+        )
+
+    def __repr__(self) -> str:
+        # part of the cache keys and config digests, i.e. has to be deterministic
+        return "AdaptiveRun(min_ess={}, max_rhat={}, draws={}-{}, growth={})".format(
+            self.min_ess,
+            self.max_rhat,
+            self.initial_draws,
+            self.max_draws,
+            self.growth,
+        )
+
+
+class MultiChain:
+    """
+    Settings of a multi-chain run, passed to a model as ``chains=MultiChain(4)``.
+
+    ``n_chains`` independently seeded chains of the same configuration run in
+    up to ``n_workers`` processes. Their draws are pooled, and the diagnostics
+    report the R-hat between the chains and the agreement (ARI) of the salso
+    partitions of the single chains, computed with ``salso_args``.
+    """
+
+    def __init__(
+        self,
+        n_chains: int = 4,
+        n_workers: int = None,
+        salso_args: dict = {"loss": "binder", "maxNCluster": 0},
+    ):
+        self.n_chains = n_chains
+        self.n_workers = n_workers
+        self.salso_args = salso_args
+
+    def __repr__(self) -> str:
+        # the number of workers does not change the result
+        return "MultiChain(n_chains={}, salso_args={})".format(
+            self.n_chains, sorted(self.salso_args.items())
+        )
+
+
+def scalar_traces(model_name: str, py_res) -> dict:
+    """
+    One scalar per saved draw: the number of clusters and the log likelihood
+    for all models, additionally phi0, lam2 and the mean alpha for drpm.
+    """
+    traces = {}
+    if model_name == "drpm":
+        # Si: (n_time_steps, n_stations, n_draws)
+        traces["nclus"] = n_clusters(np.moveaxis(py_res["Si"], 2, 0)).mean(axis=1)
+        if "llike" in py_res:
+            traces["loglik"] = np.asarray(py_res["llike"]).sum(axis=(0, 1))
+        for name in ["phi0", "lam2"]:
+            if name in py_res:
+                traces[name] = np.asarray(py_res[name]).ravel()
+        if "alpha" in py_res:
+            alpha = np.asarray(py_res["alpha"])
+            traces["alpha"] = alpha.reshape(alpha.shape[0], -1).mean(axis=1)
+    else:
+        # Si: (n_draws, n_stations)
+        traces["nclus"] = n_clusters(np.asarray(py_res["Si"])).astype(float)
+        if "like" in py_res:
+            with np.errstate(divide="ignore"):
+                traces["loglik"] = np.log(np.asarray(py_res["like"])).sum(axis=1)
+    return traces
+
+
+def draw_axis(model_name: str, values: np.ndarray) -> int:
+    """Axis of the saved draws: the last one of the drpm tensors, else the first."""
+    if model_name == "drpm" and values.ndim == 3:
+        return 2
+    return 0
+
+
+def n_draws(model_name: str, py_res) -> int:
+    Si = np.asarray(py_res["Si"])
+    return Si.shape[draw_axis(model_name, Si)]
+
+
+def pool_chains(model_name: str, chain_results: list[dict]) -> dict:
+    """
+    One result of several chains: the arrays with a draw axis (Si, fitted, ...)
+    are concatenated along it, summaries such as lpml and WAIC are averaged.
+    """
+    pooled = {}
+    for name in chain_results[0]:
+        if name == "diagnostics":
+            continue
+        values = [np.asarray(res[name]) for res in chain_results]
+        axis = draw_axis(model_name, values[0])
+        per_draw = all(
+            value.ndim > 0 and value.shape[axis] == n_draws(model_name, res)
+            for value, res in zip(values, chain_results)
+        )
+        if per_draw:
+            pooled[name] = np.concatenate(values, axis=axis)
+        else:
+            pooled[name] = np.mean(values, axis=0)
+    return pooled
+
+
+def chain_diagnostics(
+    model_name: str, chain_results: list[dict], estimates: list[np.ndarray]
+) -> dict:
+    """
+    R-hat and ESS of the scalar traces over all chains (split within chains),
+    and the pairwise ARI of the chain point estimates ``estimates`` (averaged
+    over the timesteps for drpm).
+    """
+    traces = [scalar_traces(model_name, res) for res in chain_results]
+    # chains of adaptive runs can differ in length, use their last draws
+    length = min(len(trace) for chain in traces for trace in chain.values())
+    stacked = {
+        name: np.array([chain[name][-length:] for chain in traces])
+        for name in traces[0]
+    }
+    n_chains = len(chain_results)
+    ari = np.ones((n_chains, n_chains))
+    for i, j in combinations(range(n_chains), 2):
+        ari[i, j] = ari[j, i] = partition_agreement(estimates[i], estimates[j])
+    return {
+        "n_chains": n_chains,
+        "traces": summarize(stacked),
+        "chain_ari": ari,
+        "mean_chain_ari": ari[np.triu_indices(n_chains, k=1)].mean(),
+    }
+
+
+def partition_agreement(first: np.ndarray, second: np.ndarray) -> float:
+    """ARI of two partitions, or the mean ARI of two sequences of partitions."""
+    first, second = np.atleast_2d(first), np.atleast_2d(second)
+    return float(np.mean([adjusted_rand_score(a, b) for a, b in zip(first, second)]))
+
+
+def n_clusters(partitions: np.ndarray) -> np.ndarray:
+    """Number of clusters of partitions along the last axis."""
+    ordered = np.sort(partitions, axis=-1)
+    return 1 + (np.diff(ordered, axis=-1) != 0).sum(axis=-1)
+
+
+def summarize(traces: dict, n_splits: int = 2) -> dict:
+    """ESS and split R-hat of every trace."""
+    return {
+        name: {
+            "ess": effective_sample_size(trace, n_splits=n_splits),
+            "rhat": split_rhat(trace, n_splits=n_splits),
+        }
+        for name, trace in traces.items()
+    }
+
+
+def split_chains(trace: np.ndarray, n_splits: int = 2) -> np.ndarray:
+    """
+    Split every chain of ``trace`` ((n_draws,) or (n_chains, n_draws)) into
+    ``n_splits`` parts, shape (n_chains * n_splits, n_draws // n_splits).
+    """
+    chains = np.atleast_2d(np.asarray(trace, dtype=float))
+    length = chains.shape[1] // n_splits
+    chains = chains[:, : length * n_splits]
+    return chains.reshape(chains.shape[0] * n_splits, length)
+
+
+def split_rhat(trace: np.ndarray, n_splits: int = 2) -> float:
+    chains = split_chains(trace, n_splits=n_splits)
+    n = chains.shape[1]
+    within = chains.var(axis=1, ddof=1).mean()
+    if not np.isfinite(within) or within == 0:
+        # a constant trace (e.g. always one cluster) has nothing to mix
+        return 1.0
+    between = n * chains.mean(axis=1).var(ddof=1)
+    var_plus = (n - 1) / n * within + between / n
+    return float(np.sqrt(var_plus / within))
+
+
+def effective_sample_size(trace: np.ndarray, n_splits: int = 2) -> float:
+    """
+    ESS of the split chains, with the autocorrelations combined over the chains
+    and truncated by Geyer's initial monotone sequence.
+    """
+    chains = split_chains(trace, n_splits=n_splits)
+    m, n = chains.shape
+    within = chains.var(axis=1, ddof=1).mean()
+    if not np.isfinite(within) or within == 0:
+        return float(m * n)
+    between = n * chains.mean(axis=1).var(ddof=1)
+    var_plus = (n - 1) / n * within + between / n
+
+    autocov = _autocovariance(chains)
+    rho = 1 - (within - autocov.mean(axis=0)) / var_plus
+    rho[0] = 1
+
+    # sums of neighbouring pairs, cut at the first negative one, kept monotone
+    n_pairs = (n - 1) // 2
+    pairs = rho[: 2 * n_pairs].reshape(n_pairs, 2).sum(axis=1)
+    negative = np.nonzero(pairs < 0)[0]
+    if negative.size > 0:
+        pairs = pairs[: negative[0]]
+    pairs = np.minimum.accumulate(pairs)
+    tau = -1 + 2 * pairs.sum()
+    return float(m * n / max(tau, 1 / np.log10(m * n)))
+
+
+def _autocovariance(chains: np.ndarray) -> np.ndarray:
+    """Autocovariance of every chain (biased estimator) by FFT."""
+    n = chains.shape[1]
+    centered = chains - chains.mean(axis=1, keepdims=True)
+    size = 2 ** int(np.ceil(np.log2(2 * n)))
+    spectrum = np.fft.rfft(centered, n=size, axis=1)
+    autocov = np.fft.irfft(spectrum * np.conj(spectrum), n=size, axis=1)[:, :n]
+    return autocov / n
@@ -0,0 +1,165 @@
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utils.data_loader import to_r_matrix
+
+"""
+Geometry of a set of stations: coordinates, projected coordinates, pairwise
+distances and their summary statistics, e.g. to choose the cohesion parameters
+of the spatial models. Computed once per station set and cached on disk.
+"""
+
+geometry_cache_dir = os.path.join(
+    Path(__file__).parent.parent.parent, "data/.cache/geometry"
+)
+earth_radius_km = 6371.0088
+
+# in-process cache, the same station set always gives the same object
+_geometries: dict[str, "StationGeometry"] = {}
+
+
+class StationGeometry:
+    """
+    Coordinates and distances of stations, rows in the order of ``stations``.
+
+    - ``coords``: latitude and longitude, shape (n_stations, 2), as passed to R
+    - ``projected``: equirectangular projection around the mean latitude in km
+    - ``distances``: haversine distances in km, shape (n_stations, n_stations)
+    """
+
+    def __init__(
+        self,
+        stations: np.ndarray,
+        coords: np.ndarray,
+        projected: np.ndarray = None,
+        distances: np.ndarray = None,
+    ):
+        self.stations = np.asarray(stations)
+        self.coords = np.asarray(coords, dtype=float)
+        self.projected = (
+            _equirectangular(self.coords) if projected is None else projected
+        )
+        self.distances = _haversine(self.coords) if distances is None else distances
+        self._r_coords = None
+
+    @classmethod
+    def from_data(cls, data: pd.DataFrame) -> "StationGeometry":
+        """One row per station, in the order of their first appearance."""
+        stations = data.drop_duplicates(subset="IDStations")
+        return cls(
+            stations=stations["IDStations"].to_numpy(dtype=str),
+            coords=stations[["Latitude", "Longitude"]].to_numpy(dtype=float),
+        )
+
+    @classmethod
+    def cached(
+        cls, data: pd.DataFrame, cache_dir: str = geometry_cache_dir
+    ) -> "StationGeometry":
+        """
+        Geometry of the stations in ``data``, reused from memory or disk if the
+        same stations (ids and coordinates, in the same order) were seen before.
+        """
+        stations = data.drop_duplicates(subset="IDStations")
+        ids = stations["IDStations"].to_numpy(dtype=str)
+        coords = stations[["Latitude", "Longitude"]].to_numpy(dtype=float)
+        digest = _digest(ids, coords)
+        if digest in _geometries:
+            return _geometries[digest]
+
+        path = os.path.join(cache_dir, "{}.npz".format(digest))
+        if os.path.exists(path):
+            with np.load(path) as content:
+                geometry = cls(
+                    stations=content["stations"],
+                    coords=content["coords"],
+                    projected=content["projected"],
+                    distances=content["distances"],
+                )
+        else:
+            geometry = cls(stations=ids, coords=coords)
+            geometry.save(path)
+        _geometries[digest] = geometry
+        return geometry
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{}.{}.tmp.npz".format(path[: -len(".npz")], os.getpid())
+        np.savez(
+            tmp_path,
+            stations=self.stations,
+            coords=self.coords,
+            projected=self.projected,
+            distances=self.distances,
+        )
+        os.replace(tmp_path, path)
+
+    @property
+    def n_stations(self) -> int:
+        return self.stations.shape[0]
+
+    def r_coords(self):
+        """R matrix of the coordinates, converted only once."""
+        if self._r_coords is None:
+            self._r_coords = to_r_matrix(self.coords)
+        return self._r_coords
+
+    def pairwise(self, metric: str = "coords") -> np.ndarray:
+        """
+        Distances of all station pairs (upper triangle). ``"coords"`` is the
+        euclidean distance of the coordinates as seen by sppm/drpm, ``"km"``
+        the haversine distance.
+        """
+        if metric == "coords":
+            diff = self.coords[:, None, :] - self.coords[None, :, :]
+            matrix = np.sqrt((diff**2).sum(axis=-1))
+        elif metric == "km":
+            matrix = self.distances
+        else:
+            raise NotImplementedError
+        return matrix[np.triu_indices(self.n_stations, k=1)]
+
+    def distance_summary(
+        self,
+        metric: str = "coords",
+        quantiles: tuple[float] = (0.1, 0.25, 0.5, 0.75, 0.9),
+    ) -> dict:
+        """Summary of the pairwise distances, e.g. the median for cParms."""
+        distances = self.pairwise(metric=metric)
+        summary = {
+            "min": distances.min(),
+            "mean": distances.mean(),
+            "median": np.median(distances),
+            "max": distances.max(),
+        }
+        for q, value in zip(quantiles, np.quantile(distances, quantiles)):
+            summary["q{:g}".format(100 * q)] = value
+        return summary
+
+
+def _digest(ids: np.ndarray, coords: np.ndarray) -> str:
+    content = hashlib.sha1()
+    content.update("\n".join(ids.tolist()).encode())
+    content.update(np.ascontiguousarray(coords, dtype=float).tobytes())
+    return content.hexdigest()[:20]
+
+
+def _equirectangular(coords: np.ndarray) -> np.ndarray:
+    lat, lon = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+    x = earth_radius_km * lon * np.cos(lat.mean())
+    y = earth_radius_km * lat
+    return np.column_stack([x - x.mean(), y - y.mean()])
+
+
+def _haversine(coords: np.ndarray) -> np.ndarray:
+    lat, lon = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+    dlat = lat[:, None] - lat[None, :]
+    dlon = lon[:, None] - lon[None, :]
+    a = (
+        np.sin(dlat / 2) ** 2
+        + np.cos(lat)[:, None] * np.cos(lat)[None, :] * np.sin(dlon / 2) ** 2
+    )
+    return 2 * earth_radius_km * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
@@ -5,6 +5,7 @@ import pandas as pd
 
 # from utils.data_loader import to_r_matrix, to_r_vector
 from utils.data_loader import to_r_matrix, to_r_vector, r_NULL
+from utils.geometry import StationGeometry
 
 
 class Model:
@@ -45,6 +46,32 @@ class Model:
 
         return result_dicts #The method returns a list of dictionaries (result_dicts), where each dictionary represents a unique combination of values for the parameters. The combination is obtained by taking the Cartesian product of the values associated with each key. this doesn't make a difference for gaussian_ppmx model because in gaussian_ppmx i do not have keys associated to values which are lists 
 
+    def estimated_fit_memory(
+        self, model_params: dict, n_stations: int, n_timesteps: int = 1
+    ) -> int:
+        """
+        Rough estimate of the memory (bytes) of one fit: every saved MCMC
+        iteration stores a few (n_stations x n_timesteps) draws, once in R and
+        once converted to numpy. Weekly models fit one timestep at a time.
+        """
+        draws = model_params.get("draws", 1)
+        if model_params.get("adaptive") is not None:
+            draws = model_params["adaptive"].max_draws
+        n_saved = max(1, draws - model_params.get("burn", 0)) // max(
+            1, model_params.get("thin", 1)
+        )
+        if self.uses_weekly_data:
+            n_timesteps = 1
+        # sppm/ppmx: mu, sig2, Si, like, fitted; drpm additionally gamma, eta1, ...
+        n_outputs = 8 if self.name == "drpm" else 5
+        return 2 * 8 * n_outputs * n_saved * n_stations * n_timesteps
+
+    def uses_coordinates(self, spatial: bool = True) -> bool:
+        """Whether ``load_model_specific_data`` passes station coordinates."""
+        if self.name == "drpm":
+            return spatial
+        return self.name == "sppm"
+
     def load_model_specific_data(
         self,
         data: pd.DataFrame,
@@ -58,7 +85,7 @@ class Model:
         if self.name == "sppm":
             return {
                 "y": to_r_vector(data["log_pm25"]),
-                "s": to_r_matrix(data[["Latitude", "Longitude"]].to_numpy()),
+                "s": StationGeometry.cached(data).r_coords(),
             }
         elif self.name == "gaussian_ppmx":
             param = {
@@ -73,7 +100,8 @@ class Model:
             if spatial:
                 return{
                     "y": to_r_matrix(yearly_time_series),
-                    "s_coords": to_r_matrix(data[["Latitude", "Longitude"]].to_numpy())
+                    # one row per station, same order as the rows of the time series
+                    "s_coords": StationGeometry.cached(data).r_coords(),
                 }
             else:
                 return{
@@ -93,3 +121,16 @@ def get_fitted_attr_name(model_name: str):
         return "fitted.values"
     else:
         raise NotImplementedError
+
+
+# fields of the R results which are read by the analysis (utils/results.py)
+analysis_fields = {
+    "sppm": ["Si", "lpml", "WAIC", "fitted"],
+    "gaussian_ppmx": ["Si", "lpml", "WAIC", "fitted.values"],
+    "drpm": ["Si", "lpml", "waic", "fitted", "alpha"],
+}
+
+
+def get_analysis_fields(model_name: str):
+    """Fields of the result a model needs for its analysis, ``None`` for all."""
+    return analysis_fields.get(model_name)
@@ -0,0 +1,148 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+"""
+Streaming mean and variance of the numerical covariates, used to normalize the
+covariates with statistics that are computed once instead of for every call.
+"""
+
+scopes = ["week", "year", "global"]
+
+
+class NormalizationStats:
+    """
+    Mean and variance of numerical columns per scope, accumulated in one pass.
+
+    The scope decides which rows share their statistics: ``"week"`` (one entry
+    per year and week, as the weekly models normalize), ``"year"`` or
+    ``"global"``. Every update is merged into the running count, mean and sum of
+    squared deviations (Chan et al.), so adding a week does not rescan the data
+    seen before. Weeks which were already absorbed are skipped.
+    """
+
+    def __init__(self, columns: list[str], scope: str = "week"):
+        if scope not in scopes:
+            raise ValueError("Scope has to be one of {}.".format(scopes))
+        self.columns = list(columns)
+        self.scope = scope
+        self._count: dict[tuple, np.ndarray] = {}
+        self._mean: dict[tuple, np.ndarray] = {}
+        self._m2: dict[tuple, np.ndarray] = {}
+        self.seen: set[tuple[int, int]] = set()
+
+    def key(self, year: int = None, week: int = None) -> tuple:
+        year, week = _week_id(year, week)
+        if self.scope == "week":
+            return (year, week)
+        elif self.scope == "year":
+            return (year,)
+        return ()
+
+    def update(self, data: pd.DataFrame, year: int = None, week: int = None):
+        """Merge the rows of one week into the statistics."""
+        week_id = _week_id(year, week)
+        if week_id in self.seen or data.shape[0] == 0:
+            return
+        values = data[self.columns].to_numpy(dtype=float)
+        count = np.sum(~np.isnan(values), axis=0)
+        with np.errstate(invalid="ignore"):
+            mean = np.nan_to_num(np.nanmean(values, axis=0))
+        m2 = np.nansum((values - mean) ** 2, axis=0)
+        self._merge(self.key(*week_id), count, mean, m2)
+        self.seen.add(week_id)
+
+    def update_from_frame(self, data: pd.DataFrame, year: int = None):
+        """Merge all weeks of a frame (with a ``Week`` column) in one pass."""
+        grouped = data.groupby("Week", observed=True)[self.columns]
+        counts = grouped.count()
+        means = grouped.mean()
+        m2s = grouped.var(ddof=0) * counts
+        for week in counts.index.tolist():
+            week_id = _week_id(year, week)
+            if week_id in self.seen:
+                continue
+            self._merge(
+                self.key(*week_id),
+                counts.loc[week].to_numpy(dtype=float),
+                means.loc[week].fillna(0).to_numpy(dtype=float),
+                m2s.loc[week].fillna(0).to_numpy(dtype=float),
+            )
+            self.seen.add(week_id)
+
+    def _merge(self, key: tuple, count: np.ndarray, mean: np.ndarray, m2: np.ndarray):
+        if key not in self._count:
+            self._count[key] = count.astype(float)
+            self._mean[key] = mean
+            self._m2[key] = m2
+            return
+        total = self._count[key] + count
+        delta = mean - self._mean[key]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weight = np.where(total > 0, count / total, 0.0)
+            self._m2[key] = (
+                self._m2[key]
+                + m2
+                + delta**2 * np.where(total > 0, self._count[key] * count / total, 0)
+            )
+        self._mean[key] = self._mean[key] + delta * weight
+        self._count[key] = total
+
+    def mean(self, year: int = None, week: int = None) -> np.ndarray:
+        return self._mean[self.key(year, week)]
+
+    def std(self, year: int = None, week: int = None, ddof: int = 1) -> np.ndarray:
+        key = self.key(year, week)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.sqrt(self._m2[key] / (self._count[key] - ddof))
+
+    def transform(
+        self, data: pd.DataFrame, year: int = None, week: int = None
+    ) -> pd.DataFrame:
+        """Mean zero and SD one for the columns, as one affine transform."""
+        data = data.copy()
+        values = data[self.columns].to_numpy(dtype=float)
+        data[self.columns] = (values - self.mean(year, week)) / self.std(year, week)
+        return data
+
+    def save(self, path: str):
+        entries = [
+            {
+                "key": list(key),
+                "count": self._count[key].tolist(),
+                "mean": self._mean[key].tolist(),
+                "m2": self._m2[key].tolist(),
+            }
+            for key in self._count
+        ]
+        with open(path, "w") as file:
+            json.dump(
+                {
+                    "columns": self.columns,
+                    "scope": self.scope,
+                    "entries": entries,
+                    "seen": [list(seen) for seen in self.seen],
+                },
+                file,
+            )
+
+    @classmethod
+    def load(cls, path: str) -> "NormalizationStats":
+        with open(path) as file:
+            content = json.load(file)
+        stats = cls(content["columns"], scope=content["scope"])
+        for entry in content["entries"]:
+            key = tuple(entry["key"])
+            stats._count[key] = np.array(entry["count"])
+            stats._mean[key] = np.array(entry["mean"])
+            stats._m2[key] = np.array(entry["m2"])
+        stats.seen = {tuple(seen) for seen in content["seen"]}
+        return stats
+
+
+def _week_id(year: int = None, week: int = None) -> tuple:
+    return (
+        None if year is None else int(year),
+        None if week is None else int(week),
+    )
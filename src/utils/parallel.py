@@ -0,0 +1,49 @@
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+"""
+Worker pools for independent model fits. Every worker is a fresh (spawned)
+process with its own embedded R session, since R cannot be shared between
+threads or forked processes safely.
+"""
+
+# memory of a worker before the first fit: python, R and the loaded packages
+worker_base_memory = 400 * 1024**2
+# fraction of the available memory the workers are allowed to use together
+memory_fraction = 0.8
+
+
+def default_n_workers(n_tasks: int, memory_per_task: int = None) -> int:
+    """
+    Number of workers for ``n_tasks`` tasks, bounded by the cores and, if
+    ``memory_per_task`` (bytes) is given, by the currently available memory.
+    """
+    n_workers = max(1, min(n_tasks, os.cpu_count() or 1))
+    available = available_memory()
+    if memory_per_task is not None and available is not None:
+        per_worker = worker_base_memory + memory_per_task
+        n_workers = min(n_workers, int(memory_fraction * available // per_worker))
+    return max(1, n_workers)
+
+
+def available_memory() -> int:
+    """Available physical memory in bytes, ``None`` if it cannot be queried."""
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def r_worker_pool(n_workers: int) -> ProcessPoolExecutor:
+    """Pool of spawned processes with the R packages already loaded."""
+    return ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=mp.get_context("spawn"),
+        initializer=_init_r_worker,
+    )
+
+
+def _init_r_worker():
+    # importing the clustering module loads ppmSuite, drpm and salso once
+    import utils.clustering  # noqa: F401
@@ -0,0 +1,411 @@
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+"""
+Point estimates of a partition from MCMC draws in numpy, as an alternative to the
+R package salso (Dahl et al.). The expected loss of a partition is computed from
+the posterior similarity matrix (PSM): exactly for Binder's loss and as the lower
+bound of Wade and Ghahramani (2018) for the variation of information (VI). The
+search starts from the best MCMC draws and random draws and improves them by
+sweetening, i.e. moving single items to the cluster which reduces the loss most,
+until no move helps.
+
+Both losses are a constant plus a sum of one term per cluster, so a move only has
+to update the terms of the two clusters involved.
+
+The PSMs are accumulated from chunks of draws (``PosteriorSimilarity``), so the
+memory needed does not grow with the length of the chain.
+"""
+
+losses = ["binder", "VI"]
+# draws processed at once when accumulating the PSM
+chunk_draws = 1000
+
+
+class PosteriorSimilarity:
+    """
+    Posterior similarity matrices of ``n_steps`` timesteps (one for the weekly
+    models), accumulated from chunks of draws in O(n_steps x n_items^2) memory.
+    """
+
+    def __init__(self, n_items: int, n_steps: int = 1):
+        self.counts = np.zeros((n_steps, n_items, n_items))
+        self.n_draws = 0
+
+    @classmethod
+    def from_draws(cls, Si, chunk_size: int = chunk_draws) -> "PosteriorSimilarity":
+        """
+        PSMs of all draws of ``Si``, in the layout of the models: (n_draws,
+        n_items), or (n_steps, n_items, n_draws) for drpm. Memory-mapped draws
+        are read chunk by chunk.
+        """
+        if Si.ndim == 2:
+            similarity = cls(n_items=Si.shape[1])
+            for start in range(0, Si.shape[0], chunk_size):
+                similarity.update(Si[start : start + chunk_size])
+        else:
+            similarity = cls(n_items=Si.shape[1], n_steps=Si.shape[0])
+            for start in range(0, Si.shape[2], chunk_size):
+                similarity.update(Si[:, :, start : start + chunk_size])
+        return similarity
+
+    def update(self, Si):
+        """Add a chunk of draws, in the layout of ``from_draws``."""
+        Si = np.asarray(Si)
+        if Si.ndim == 2:
+            self.counts[0] += _coclustering_counts(Si)
+            self.n_draws += Si.shape[0]
+        else:
+            for step in range(Si.shape[0]):
+                self.counts[step] += _coclustering_counts(Si[step].T)
+            self.n_draws += Si.shape[2]
+
+    @property
+    def psm(self) -> np.ndarray:
+        """Shares of the draws with two items together, (n_steps, n, n)."""
+        return self.counts / max(1, self.n_draws)
+
+    def uncertainty(self) -> np.ndarray:
+        """
+        Co-clustering uncertainty of every item and timestep, (n_steps, n): the
+        mean of p_ij (1 - p_ij) over the other items j, 0 if the posterior is
+        certain about the cluster of item i and at most 0.25.
+        """
+        psm = self.psm
+        n_items = psm.shape[1]
+        return (psm * (1 - psm)).sum(axis=2) / max(1, n_items - 1)
+
+    def estimate(self, **salso_args) -> np.ndarray:
+        """Partition of every timestep by ``salso_from_psm``, (n_steps, n)."""
+        return np.array([salso_from_psm(psm, **salso_args) for psm in self.psm])
+
+
+def posterior_similarity(Si: np.ndarray) -> np.ndarray:
+    """
+    Share of the draws in which two items are clustered together, for draws
+    ``Si`` of shape (n_draws, n_items).
+    """
+    return PosteriorSimilarity.from_draws(Si).psm[0]
+
+
+def salso(
+    Si: np.ndarray,
+    loss: str = "binder",
+    maxNCluster: int = 0,
+    nRuns: int = 16,
+    maxSweeps: int = 50,
+    seed: int = None,
+    **kwargs,
+) -> np.ndarray:
+    """
+    Partition of the items minimizing the expected ``loss`` (``"binder"`` or
+    ``"VI"``) of the draws ``Si`` (n_draws, n_items). The arguments follow
+    ``salso::salso``; ``maxNCluster=0`` means no limit. Arguments of the R
+    package which have no counterpart here (e.g. ``nCores``) are ignored. The
+    clusters are labelled 1, 2, ... in the order of their first item. Without a
+    ``seed``, the search is seeded from the global numpy state.
+    """
+    if loss not in losses:
+        raise NotImplementedError("Loss has to be one of {}.".format(losses))
+    psm = posterior_similarity(Si)
+    n_items = psm.shape[0]
+    max_clusters = n_items if maxNCluster <= 0 else min(maxNCluster, n_items)
+    objective = _Objective(psm, loss)
+    rng = _default_rng(seed)
+
+    # starting points: the best distinct draws and random draws of the chain,
+    # chosen chunk by chunk
+    n_best = max(1, nRuns // 2)
+    n_random = max(0, nRuns - n_best)
+    best_draws = np.zeros((0, n_items), dtype=int)
+    best_losses = np.zeros(0)
+    random_draws = []
+    for start in range(0, Si.shape[0], chunk_draws):
+        draws = _relabel_draws(np.asarray(Si[start : start + chunk_draws]))
+        draws = draws[draws.max(axis=1) < max_clusters]
+        if draws.shape[0] == 0:
+            continue
+        candidates = np.concatenate([best_draws, draws])
+        candidate_losses = np.concatenate([best_losses, objective.losses(draws)])
+        keep, seen = [], set()
+        for idx in np.argsort(candidate_losses, kind="stable"):
+            if len(keep) >= n_best:
+                break
+            if candidates[idx].tobytes() not in seen:
+                seen.add(candidates[idx].tobytes())
+                keep.append(idx)
+        best_draws, best_losses = candidates[keep], candidate_losses[keep]
+        size = min(n_random, draws.shape[0])
+        random_draws.extend(draws[rng.choice(draws.shape[0], size, replace=False)])
+    starts = list(best_draws)
+    if len(random_draws) > 0:
+        size = min(nRuns - len(starts), len(random_draws))
+        picked = rng.choice(len(random_draws), size, replace=False)
+        starts.extend(random_draws[idx] for idx in picked)
+    return _search(objective, starts, max_clusters, max(1, nRuns), maxSweeps, rng)
+
+
+def salso_from_psm(
+    psm: np.ndarray,
+    loss: str = "binder",
+    maxNCluster: int = 0,
+    nRuns: int = 16,
+    maxSweeps: int = 50,
+    seed: int = None,
+    **kwargs,
+) -> np.ndarray:
+    """
+    ``salso`` from a posterior similarity matrix instead of the draws, e.g. of
+    ``PosteriorSimilarity``. The search starts from the partition of linking
+    pairs with a similarity above 0.5, one cluster, singletons and random
+    partitions.
+    """
+    if loss not in losses:
+        raise NotImplementedError("Loss has to be one of {}.".format(losses))
+    n_items = psm.shape[0]
+    max_clusters = n_items if maxNCluster <= 0 else min(maxNCluster, n_items)
+    rng = _default_rng(seed)
+    starts = [
+        _threshold_partition(psm),
+        np.zeros(n_items, dtype=int),
+        np.arange(n_items),
+    ]
+    starts = [start for start in starts if start.max() < max_clusters]
+    objective = _Objective(psm, loss)
+    return _search(objective, starts, max_clusters, max(1, nRuns), maxSweeps, rng)
+
+
+def salso_many(
+    Si_per_step: list[np.ndarray], n_workers: int = 1, **salso_args
+) -> np.ndarray:
+    """
+    ``salso`` for several sets of draws, e.g. the weeks of drpm, in up to
+    ``n_workers`` processes. Returns one partition per row.
+    """
+    # the seeds are drawn here, the workers do not share the numpy state
+    seed = salso_args.pop("seed", None)
+    if seed is None:
+        seeds = np.random.randint(0, 2**31, size=len(Si_per_step))
+    else:
+        seeds = [seed] * len(Si_per_step)
+    if n_workers <= 1 or len(Si_per_step) <= 1:
+        return np.array(
+            [
+                salso(Si, seed=int(step_seed), **salso_args)
+                for Si, step_seed in zip(Si_per_step, seeds)
+            ]
+        )
+    with ProcessPoolExecutor(
+        max_workers=min(n_workers, len(Si_per_step)),
+        mp_context=mp.get_context("spawn"),
+    ) as executor:
+        futures = [
+            executor.submit(salso, Si, seed=int(step_seed), **salso_args)
+            for Si, step_seed in zip(Si_per_step, seeds)
+        ]
+        return np.array([future.result() for future in futures])
+
+
+def _search(objective, starts, max_clusters, n_runs, max_sweeps, rng) -> np.ndarray:
+    """Sweeten the starts, filled up to ``n_runs`` with random ones; the best."""
+    starts = list(starts)
+    while len(starts) < n_runs:
+        starts.append(rng.integers(0, max_clusters, size=objective.n_items))
+    best, best_loss = None, np.inf
+    for start in starts:
+        partition = objective.sweeten(
+            start, max_clusters=max_clusters, max_sweeps=max_sweeps, rng=rng
+        )
+        partition_loss = objective.loss(partition)
+        if partition_loss < best_loss - 1e-12:
+            best, best_loss = partition, partition_loss
+    return _relabel(best) + 1
+
+
+def expected_loss(partition: np.ndarray, Si: np.ndarray, loss: str = "binder") -> float:
+    """Expected loss of a partition (Binder's, or the lower bound of VI)."""
+    objective = _Objective(posterior_similarity(Si), loss)
+    return objective.loss(_relabel(np.asarray(partition)))
+
+
+class _Objective:
+    """
+    Expected loss as a constant plus one term per cluster. The search keeps
+    ``WZ``, the sums of the pair weights ``W`` of every item over the members of
+    every cluster (``Z`` is the one-hot matrix of the partition), so the change
+    of the loss of all moves of an item is a few vector operations.
+    """
+
+    def __init__(self, psm: np.ndarray, loss: str):
+        self.psm = psm
+        self.loss_name = loss
+        self.n_items = psm.shape[0]
+        if loss == "binder":
+            # sum_{i<j} p_ij + sum_k sum_{i<j in k} (1 - 2 p_ij)
+            self.weights = 1 - 2 * psm
+            np.fill_diagonal(self.weights, 0)
+            self.constant = np.triu(psm, k=1).sum()
+        else:
+            # n * VI_lb = sum_i log2(sum_j p_ij)
+            #   + sum_k (n_k log2 n_k - 2 sum_{i in k} log2(sum_{j in k} p_ij))
+            self.weights = psm
+            self.constant = np.log2(psm.sum(axis=1)).sum()
+
+    def losses(self, partitions: np.ndarray) -> np.ndarray:
+        """Expected loss of partitions (rows) labelled 0, 1, ..."""
+        partitions = np.atleast_2d(partitions)
+        n_partitions, n_items = partitions.shape
+        one_hot = np.zeros((n_partitions, n_items, partitions.max() + 1))
+        np.put_along_axis(one_hot, partitions[:, :, None], 1.0, axis=2)
+        # sums of the weights of every item over the members of its own cluster
+        own = np.take_along_axis(
+            np.matmul(self.weights, one_hot),
+            partitions[:, :, None],
+            axis=2,
+        )[:, :, 0]
+        if self.loss_name == "binder":
+            return self.constant + own.sum(axis=1) / 2
+        sizes = np.take_along_axis(one_hot.sum(axis=1), partitions, axis=1)
+        terms = np.log2(sizes) - 2 * np.log2(own)
+        return (self.constant + terms.sum(axis=1)) / n_items
+
+    def loss(self, partition: np.ndarray) -> float:
+        return float(self.losses(partition)[0])
+
+    def sweeten(
+        self,
+        partition: np.ndarray,
+        max_clusters: int,
+        max_sweeps: int,
+        rng: np.random.Generator,
+    ) -> np.ndarray:
+        """Move single items to their best cluster until nothing improves."""
+        partition = _relabel(np.asarray(partition)).copy()
+        n = self.n_items
+        Z = np.zeros((n, n))
+        Z[np.arange(n), partition] = 1
+        WZ = self.weights @ Z
+        sizes = Z.sum(axis=0)
+        del Z
+
+        for _ in range(max_sweeps):
+            moved = False
+            for item in rng.permutation(n):
+                current = partition[item]
+                delta = self._move_deltas(item, current, partition, WZ, sizes)
+                # at most one empty cluster is a candidate, none beyond the limit
+                empty = np.flatnonzero(sizes == 0)
+                n_used = n - empty.size
+                if empty.size > 0:
+                    delta[empty[1:]] = np.inf
+                    if n_used >= max_clusters and sizes[current] > 1:
+                        delta[empty[0]] = np.inf
+                delta[current] = 0.0
+                target = int(np.argmin(delta))
+                if delta[target] >= -1e-12 or target == current:
+                    continue
+                moved = True
+                column = self.weights[:, item]
+                WZ[:, current] -= column
+                WZ[:, target] += column
+                sizes[current] -= 1
+                sizes[target] += 1
+                partition[item] = target
+            if not moved:
+                break
+        return partition
+
+    def _move_deltas(self, item, current, partition, WZ, sizes) -> np.ndarray:
+        """Change of the loss if ``item`` moves to each cluster (column)."""
+        if self.loss_name == "binder":
+            return WZ[item] - WZ[item, current]
+
+        n = self.n_items
+        column = self.psm[:, item]
+        # sum of the similarities of every item to the members of its cluster
+        own = WZ[np.arange(n), partition]
+        log_own = np.log2(own)
+        in_current = partition == current
+        others = in_current.copy()
+        others[item] = False
+        removal = (
+            _xlog2x(sizes[current] - 1)
+            - _xlog2x(sizes[current])
+            - 2
+            * (np.log2(own[others] - column[others]).sum() - log_own[in_current].sum())
+        )
+        # joining every cluster, an empty one is a new singleton
+        old = np.bincount(partition, weights=log_own, minlength=n)
+        new = np.bincount(partition, weights=np.log2(own + column), minlength=n)
+        joining = (
+            _xlog2x(sizes + 1)
+            - _xlog2x(sizes)
+            - 2 * (new - old + np.log2(WZ[item] + 1))
+        )
+        return joining + removal
+
+
+def _default_rng(seed: int = None) -> np.random.Generator:
+    """
+    Generator of a search; without a ``seed`` it is seeded from the global numpy
+    state, so the result is reproducible after ``set_r_python_seed``.
+    """
+    if seed is None:
+        seed = np.random.randint(0, 2**31)
+    return np.random.default_rng(seed)
+
+
+def _coclustering_counts(Si: np.ndarray) -> np.ndarray:
+    """Number of draws (rows of ``Si``) in which two items are clustered together."""
+    n_draws, n_items = Si.shape
+    labels = _relabel_draws(Si)
+    # items x (draw, cluster) indicators, the counts are one matrix product
+    n_labels = labels.max() + 1
+    indicators = np.zeros((n_items, n_draws * n_labels))
+    columns = labels + n_labels * np.arange(n_draws)[:, None]
+    indicators[np.arange(n_items)[None, :], columns] = 1.0
+    return indicators @ indicators.T
+
+
+def _threshold_partition(psm: np.ndarray) -> np.ndarray:
+    """Connected components of the pairs with a similarity above 0.5."""
+    partition = -np.ones(psm.shape[0], dtype=int)
+    n_clusters = 0
+    for item in range(psm.shape[0]):
+        if partition[item] >= 0:
+            continue
+        queue = [item]
+        partition[item] = n_clusters
+        while queue:
+            neighbours = np.flatnonzero((psm[queue.pop()] > 0.5) & (partition < 0))
+            partition[neighbours] = n_clusters
+            queue.extend(neighbours)
+        n_clusters += 1
+    return partition
+
+
+def _xlog2x(x):
+    x = np.asarray(x, dtype=float)
+    return np.where(x > 0, x * np.log2(np.maximum(x, 1)), 0.0)
+
+
+def _relabel(partition: np.ndarray) -> np.ndarray:
+    """Labels 0, 1, ... in the order of the first item of each cluster."""
+    _, first, inverse = np.unique(partition, return_index=True, return_inverse=True)
+    order = np.argsort(np.argsort(first))
+    return order[inverse]
+
+
+def _relabel_draws(Si: np.ndarray) -> np.ndarray:
+    """``_relabel`` for every draw (row), vectorized over the draws."""
+    Si = np.asarray(Si)
+    n_draws, n_items = Si.shape
+    # first occurrence of the label of every item within its draw
+    matches = Si[:, :, None] == Si[:, None, :]
+    first = matches.argmax(axis=2)
+    is_first = first == np.arange(n_items)
+    # the label is the number of first occurrences before that first item
+    rank = np.cumsum(is_first, axis=1) - 1
+    return np.take_along_axis(rank, first, axis=1)
@@ -0,0 +1,225 @@
+import hashlib
+import logging
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import rpy2.rinterface as ri
+import rpy2.robjects as ro
+
+"""
+Persistent cache of the fitted models. An entry is addressed by the hash of the
+model name, all arguments passed to R (R objects by their serialized content),
+the state of the R random number generator before the fit and the versions of R
+and of the package which fits the model. A hit therefore returns exactly what the
+fit would have returned, and also leaves the R generator in the state after the
+fit, so the following fits of a run do not change either.
+
+An entry is a directory with one uncompressed ``.npy`` file per field, which are
+memory-mapped when the entry is loaded, so a hit does not read the arrays into
+memory.
+"""
+
+result_cache_dir = os.path.join(
+    Path(__file__).parent.parent.parent, "data/.cache/results"
+)
+result_cache_max_bytes = 4 * 1024**3
+_result_cache_version = 2
+# fields up to this size are loaded instead of mapped
+_small_array_bytes = 64 * 1024
+
+# R package which fits the model
+model_packages = {"sppm": "ppmSuite", "gaussian_ppmx": "ppmSuite", "drpm": "drpm"}
+
+# entries of the stored files which are not part of the result
+_time_key = "__time_needed__"
+_seed_key = "__random_seed__"
+
+_versions: dict[str, str] = {}
+
+
+class ResultCache:
+    """
+    Fitted results stored as directories of ``.npy`` files in ``cache_dir``. The
+    least recently used entries are removed once the files exceed ``max_bytes``
+    together.
+    """
+
+    def __init__(
+        self, cache_dir: str = result_cache_dir, max_bytes: int = result_cache_max_bytes
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, model: str, kwargs: dict) -> str:
+        content = hashlib.sha256()
+        content.update(
+            "{}:{}:{}:{}".format(
+                _result_cache_version, model, _r_version(), _package_version(model)
+            ).encode()
+        )
+        for name in sorted(kwargs):
+            content.update(name.encode())
+            content.update(digest_value(kwargs[name]))
+        content.update(digest_value(_random_seed()))
+        return content.hexdigest()[:32]
+
+    def get(self, key: str):
+        """
+        Result dict (memory-mapped arrays) and fit time of an entry, ``None`` if
+        there is none.
+        """
+        path = self._path(key)
+        if not os.path.isdir(path):
+            self.misses += 1
+            return None
+        result = {}
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".npy"):
+                result[name[: -len(".npy")]] = _load_field(os.path.join(path, name))
+        time_needed = float(result.pop(_time_key))
+        random_seed = result.pop(_seed_key, None)
+        if random_seed is not None:
+            _set_random_seed(random_seed)
+        # the modification time marks the last use
+        os.utime(path)
+        self.hits += 1
+        return result, time_needed
+
+    def put(self, key: str, result: dict, time_needed: float):
+        """Store a result dict with the state of the R generator after the fit."""
+        if any(np.asarray(value).dtype == object for value in result.values()):
+            # only plain arrays can be loaded without pickle
+            return
+        path = self._path(key)
+        entries = dict(result)
+        entries[_time_key] = np.array(time_needed)
+        random_seed = _random_seed()
+        if random_seed is not None:
+            entries[_seed_key] = random_seed
+        # the entry appears as a whole once all fields are written
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name, values in entries.items():
+            np.save(os.path.join(tmp_path, "{}.npy".format(name)), values)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until they fit ``max_bytes``."""
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        sizes = {entry.path: _entry_size(entry.path) for entry in entries}
+        total = sum(sizes.values())
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            total -= sizes[entry.path]
+            shutil.rmtree(entry.path, ignore_errors=True)
+            self.evictions += 1
+
+    def clear(self):
+        for entry in self._entries():
+            shutil.rmtree(entry.path, ignore_errors=True)
+        if os.path.isdir(self.cache_dir):
+            # entries of the former single-file format
+            for entry in os.scandir(self.cache_dir):
+                if entry.is_file() and entry.name.endswith(".npz"):
+                    os.remove(entry.path)
+
+    def stats(self) -> dict:
+        entries = list(self._entries())
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "size_mb": sum(_entry_size(entry.path) for entry in entries) / 1024**2,
+            "max_size_mb": self.max_bytes / 1024**2,
+        }
+
+    def report(self):
+        logging.info(
+            "Result cache: {hits} hits, {misses} misses, {evictions} evictions, "
+            "{entries} entries with {size_mb:.1f}/{max_size_mb:.0f} MB".format(
+                **self.stats()
+            )
+        )
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def _entries(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        return [
+            entry
+            for entry in os.scandir(self.cache_dir)
+            if entry.is_dir() and ".tmp" not in entry.name
+        ]
+
+
+_default_cache: ResultCache = None
+
+
+def default_result_cache() -> ResultCache:
+    """Cache used by ``Cluster.cluster``, shared within a process."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ResultCache()
+    return _default_cache
+
+
+def digest_value(value) -> bytes:
+    """Bytes which identify an argument by its content."""
+    if value is None:
+        return b"None"
+    if isinstance(value, ri.Sexp):
+        # R objects (vectors, matrices, data frames, NULL) by their serialization
+        return hashlib.sha256(bytes(ro.r["serialize"](value, ri.NULL))).digest()
+    if isinstance(value, np.ndarray):
+        content = hashlib.sha256("{}{}".format(value.dtype, value.shape).encode())
+        content.update(np.ascontiguousarray(value).tobytes())
+        return content.digest()
+    return "{}:{!r}".format(type(value).__name__, value).encode()
+
+
+def _load_field(path: str) -> np.ndarray:
+    values = np.load(path, mmap_mode="r")
+    if values.nbytes <= _small_array_bytes:
+        values = np.array(values)
+    return values
+
+
+def _entry_size(path: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(path))
+
+
+def _random_seed():
+    """State of the R generator, ``None`` before it was used the first time."""
+    if not ro.r('exists(".Random.seed", envir = globalenv())')[0]:
+        return None
+    return np.asarray(ro.globalenv[".Random.seed"], dtype=np.int32)
+
+
+def _set_random_seed(random_seed: np.ndarray):
+    ro.globalenv[".Random.seed"] = ro.IntVector(random_seed.tolist())
+
+
+def _r_version() -> str:
+    if "R" not in _versions:
+        _versions["R"] = ro.r("R.version.string")[0]
+    return _versions["R"]
+
+
+def _package_version(model: str) -> str:
+    package = model_packages.get(model, model)
+    if package not in _versions:
+        version = ro.r('as.character(packageVersion("{}"))'.format(package))
+        _versions[package] = version[0]
+    return _versions[package]
@@ -1,13 +1,33 @@
+import bisect
+
 import numpy as np
 import pandas as pd
+import rpy2.rinterface as ri
+import rpy2.robjects as ro
 import rpy2.robjects.packages as rpackages
-from sklearn.metrics import adjusted_rand_score
 
-from utils.data_loader import to_r_matrix, to_r_int_vector
+from utils.data_loader import to_r_array, to_r_matrix
+from utils import partition
 from utils.models import get_fitted_attr_name
 
 salso = rpackages.importr("salso")
 
+# salso of every timestep of a drpm Si array (n_timesteps, n_stations, n_draws)
+# in one call, returns the partitions as integer matrix (n_timesteps, n_stations)
+_r_salso_per_timestep = """
+function(Si, ...) {
+    n_stations <- dim(Si)[2]
+    n_draws <- dim(Si)[3]
+    partitions <- vapply(
+        seq_len(dim(Si)[1]),
+        function(t) as.integer(salso::salso(t(matrix(Si[t, , ], n_stations, n_draws)), ...)),
+        integer(n_stations)
+    )
+    t(matrix(partitions, nrow = n_stations))
+}
+"""
+_r_functions = {}
+
 kpis = [
     "lpml",
     "waic",
@@ -23,15 +43,24 @@ kpis = [
     "max_pm25_diff",
 ]
 
-# how to evaluate a weekly clustering
+# how to evaluate a weekly clustering, from the cluster sizes of all weeks
+# (n_weeks, n_labels), 0 for the labels not used in a week
 cluster_size_weekly_kpi = {
-    "n_singletons": lambda unique, counts: counts[counts == 1].shape[0],
-    "n_clusters": lambda unique, counts: unique.shape[0],
-    "max_cluster_size": lambda unique, counts: np.max(counts),
-    "min_cluster_size": lambda unique, counts: np.min(counts),
-    "mean_cluster_size": lambda unique, counts: np.mean(counts),
-    "mode_cluster_size": lambda unique, counts: np.median(counts),
+    "n_singletons": lambda sizes: (sizes == 1).sum(axis=1),
+    "n_clusters": lambda sizes: (sizes > 0).sum(axis=1),
+    "max_cluster_size": lambda sizes: sizes.max(axis=1),
+    "min_cluster_size": lambda sizes: np.where(sizes > 0, sizes, sizes.max()).min(
+        axis=1
+    ),
+    "mean_cluster_size": lambda sizes: sizes.sum(axis=1) / (sizes > 0).sum(axis=1),
+    "mode_cluster_size": lambda sizes: np.nanmedian(
+        np.where(sizes > 0, sizes, np.nan), axis=1
+    ),
 }
+# central posterior predictive interval whose coverage is reported
+coverage_quantiles = (0.05, 0.95)
+# fitted draws are summarized in chunks of about this size
+summary_chunk_bytes = 64 * 1024**2
 # how to aggregate from weekly to yearly
 agg_mapping = {
     "lpml": max,
@@ -79,6 +108,10 @@ class YearlyPerformance:
             res["alpha"] = np.array([week["alpha"] for week in weekly_results])
         except:
             pass
+        if "diagnostics" in weekly_results[0]:
+            res["diagnostics"] = [week["diagnostics"] for week in weekly_results]
+        if "coverage" in weekly_results[0]:
+            res["coverage"] = np.array([week["coverage"] for week in weekly_results])
 
         return res
 
@@ -154,13 +187,26 @@ class ModelPerformance: #class designed to track the performance of a specific B
     def __init__(self, name: str):
         self.name = name #gaussian_ppmx
         self.test_cases: list[YearlyPerformance] = [] #test_cases is a list of elements of the YearlyPerfromance class and it is initialized as empty
+        self._case_indices: list[int] = []
 
     def add_testcase(
-        self, yearly_result: YearlyPerformance, show_to_console: bool = False
+        self,
+        yearly_result: YearlyPerformance,
+        show_to_console: bool = False,
+        case_index: int = None,
     ):
+        """
+        Add the result of a test case. Results which finish out of order (e.g.
+        from a parallel grid run) are inserted by their ``case_index``, so the
+        order of the table does not depend on which case finished first.
+        """
         if show_to_console:
             print(yearly_result)
-        self.test_cases.append(yearly_result)
+        if case_index is None:
+            case_index = self._case_indices[-1] + 1 if self._case_indices else 0
+        position = bisect.bisect(self._case_indices, case_index)
+        self._case_indices.insert(position, case_index)
+        self.test_cases.insert(position, yearly_result)
 
     def to_table(self, select_params: list[str] = None) -> pd.DataFrame:
         """Create a table for each test case of the model, i.e. a complete overview.
@@ -205,12 +251,16 @@ class Analyse:
         analysis["lpml"] = py_res["lpml"]
         analysis["waic"] = py_res["WAIC"]
         target = np.array(target)
+        summary = posterior_summary(
+            py_res[get_fitted_attr_name(model_name=model_name)], draw_axis=0
+        )
         analysis["mse"] = MSE(
             target=target,
             # we use the mean of the MCMC samples to estimate the prediction value
-            prediction=py_res[get_fitted_attr_name(model_name=model_name)].mean(axis=0),
+            prediction=summary["mean"],
             axis=0,
         )
+        analysis["coverage"] = interval_coverage(target, *summary["quantiles"])
 
         try:
             analysis["alpha"] = np.average(py_res["alpha"])
@@ -219,26 +269,17 @@ class Analyse:
             pass
 
         # analyse number of cluster distribution
-        salso_partition = np.array(
-            salso.salso(
-                to_r_matrix(py_res["Si"]),
-                **salso_args,
-            )
-        )
+        salso_partition = estimate_partition(py_res["Si"], salso_args=salso_args)
 
         # analyse time-dependency of partitions with lagged ARI values
         analysis["salso_partition"] = salso_partition
-        analysis["max_pm25_diff"] = max_pm25_diff_per_cluster(target, salso_partition)
-
-        unique, counts = np.unique(salso_partition, return_counts=True)
-        # init the results and fill with evaluation function
-        for key in cluster_size_weekly_kpi.keys():
-            analysis[key] = []
-
-        for key, lam_eval in cluster_size_weekly_kpi.items():
-            analysis[key].append(lam_eval(unique=unique, counts=counts))
+        weekly_kpis = weekly_cluster_kpis(target[None, :], salso_partition[None, :])
+        analysis["max_pm25_diff"] = weekly_kpis.pop("max_pm25_diff")[0]
+        analysis.update(weekly_kpis)
 
         analysis["time"] = time_needed
+        if "diagnostics" in py_res:
+            analysis["diagnostics"] = py_res["diagnostics"]
         return analysis
 
     @staticmethod
@@ -250,32 +291,33 @@ class Analyse:
     ) -> dict:
         analysis = {}
         analysis["time"] = time_needed
+        if "diagnostics" in py_res:
+            analysis["diagnostics"] = py_res["diagnostics"]
 
         analysis["lpml"] = py_res["lpml"]
         analysis["waic"] = py_res["waic"]
 
-        # analyse the partitions for each week since salso cannot handle tensors
-        SI_np = np.array(py_res["Si"])
-
+        # the fitted draws are read in chunks, e.g. from a spilled result
+        summary = posterior_summary(py_res["fitted"], draw_axis=2)
+        prediction = summary["mean"].T
+        lower, upper = (quantile.T for quantile in summary["quantiles"])
         # weekly MSE, shape (n_weeks, n_stations)
-        analysis["mse"] = MSE(
-            target=target, prediction=py_res["fitted"].mean(axis=2).T, axis=0
-        )
+        analysis["mse"] = MSE(target=target, prediction=prediction, axis=0)
+        analysis["mse_station"] = MSE(target=target, prediction=prediction, axis=1)
+        analysis["coverage"] = interval_coverage(target, lower, upper, axis=0)
         analysis["alpha"] = py_res["alpha"].mean(axis=0)
         analysis["alpha_std"] = py_res["alpha"].std(axis=0)
 
-        num_weeks = SI_np.shape[0]
-        analysis["partition"] = np.array(
-            [
-                np.array(
-                    salso.salso(
-                        to_r_matrix(SI_np[week, :, :].T),
-                        **salso_args,
-                    )
-                )
-                for week in range(num_weeks)
-            ]
-        )
+        if "partition" in py_res:
+            # estimated by Cluster.cluster before the result was converted
+            analysis["partition"] = np.asarray(py_res["partition"])
+        else:
+            # Si stays in R if it was not converted yet
+            analysis["partition"] = salso_point_estimate(
+                unconverted_field(py_res, "Si"),
+                model_name="drpm",
+                salso_args=salso_args,
+            )
 
         analysis["laggedRI"] = laggedRI(
             firstweek=1, lastweek=52, salso_pars=analysis["partition"]
@@ -284,63 +326,225 @@ class Analyse:
             firstweek=1, lastweek=52, salso_pars=analysis["partition"]
         )
 
-        # decompose the yearly clustering into weekly chunks for detailed analysis
-        analysis["max_pm25_diff"] = []
-        for kpi in cluster_size_weekly_kpi.keys():
-            analysis[kpi] = []
+        # decompose the yearly clustering into weekly values for detailed analysis
+        analysis.update(weekly_cluster_kpis(target.T, analysis["partition"]))
+        return analysis
 
-        for week in range(num_weeks):
-            unique, counts = np.unique(
-                analysis["partition"][week, :], return_counts=True
-            )
 
-            analysis["max_pm25_diff"].append(
-                max_pm25_diff_per_cluster(
-                    target[:, week], analysis["partition"][week, :]
-                )
-            )
+def salso_point_estimate(
+    Si: np.ndarray,
+    model_name: str,
+    salso_args: dict = {"loss": "binder", "maxNCluster": 0},
+) -> np.ndarray:
+    """
+    Salso partition of the draws ``Si``: one partition for the weekly models,
+    Si of shape (n_draws, n_stations), and one per timestep for drpm, Si of
+    shape (n_timesteps, n_stations, n_draws) as numpy or R array.
+    """
+    if model_name == "drpm":
+        return estimate_partitions(Si, salso_args=salso_args)
+    return estimate_partition(Si, salso_args=salso_args)
+
+
+def estimate_partition(
+    Si: np.ndarray, salso_args: dict = {"loss": "binder", "maxNCluster": 0}
+) -> np.ndarray:
+    """
+    Salso partition of draws ``Si`` (n_draws, n_stations). ``salso_args`` are
+    passed to the R package salso, unless they contain ``"engine": "numpy"``,
+    then the estimate of ``utils/partition.py`` is used instead.
+    """
+    salso_args = dict(salso_args)
+    if salso_args.pop("engine", "r") == "numpy":
+        return partition.salso(Si, **salso_args)
+    return np.array(salso.salso(to_r_matrix(Si), **salso_args))
+
+
+def estimate_partitions(
+    Si, salso_args: dict = {"loss": "binder", "maxNCluster": 0}
+) -> np.ndarray:
+    """
+    ``estimate_partition`` for every timestep of ``Si`` (n_timesteps,
+    n_stations, n_draws), shape (n_timesteps, n_stations). With R, all
+    timesteps are estimated in a single call (``nCores`` is passed to salso) and
+    an R array ``Si`` is not copied; with the numpy engine, the timesteps are
+    estimated in ``nCores`` processes.
+    """
+    salso_args = dict(salso_args)
+    if salso_args.pop("engine", "r") == "numpy":
+        if isinstance(Si, ri.Sexp):
+            Si = np.asarray(Si)
+        # memory-mapped draws are read week by week
+        n_workers = salso_args.pop("nCores", 1) or 1
+        return partition.salso_many(
+            [np.asarray(Si[step, :, :]).T for step in range(Si.shape[0])],
+            n_workers=n_workers,
+            **salso_args,
+        )
+    if not isinstance(Si, ri.Sexp):
+        Si = to_r_array(Si, dtype=np.int32)
+    if "salso_per_timestep" not in _r_functions:
+        _r_functions["salso_per_timestep"] = ro.r(_r_salso_per_timestep)
+    return np.array(_r_functions["salso_per_timestep"](Si, **salso_args), dtype=int)
 
-            for key, lam_eval in cluster_size_weekly_kpi.items():
-                analysis[key].append(lam_eval(unique=unique, counts=counts))
-        return analysis
+
+def unconverted_field(py_res, name: str):
+    """
+    A field of a result as R object if it is a ``LazyResult`` which did not
+    convert it yet, otherwise as array.
+    """
+    if hasattr(py_res, "unconverted"):
+        return py_res.unconverted(name)
+    return py_res[name]
 
 
 def MSE(target: np.ndarray, prediction: np.ndarray, axis: int):
     return ((target - prediction) ** 2).mean(axis=axis)
 
 
-def max_pm25_diff_per_cluster(target: np.ndarray, salso_partition: np.array):
-    return max(
-        [
-            (
-                target[np.where(salso_partition == i)].max()
-                - target[np.where(salso_partition == i)].min()
-            )
-            # cluster labels start at value 1
-            for i in range(1, np.amax(salso_partition) + 1)
-        ]
+def posterior_summary(
+    draws: np.ndarray,
+    draw_axis: int = 0,
+    quantiles: tuple[float] = coverage_quantiles,
+    chunk_bytes: int = summary_chunk_bytes,
+) -> dict:
+    """
+    Posterior mean, variance and ``quantiles`` of ``draws`` (e.g. the fitted
+    values, also memory-mapped) over their ``draw_axis``. The draws are read in
+    blocks of about ``chunk_bytes`` along another axis (at least one index of
+    it), so only one block is held in memory as float64.
+    """
+    shape = draws.shape
+    chunk_axis = 1 if draw_axis == 0 else 0
+    summary_shape = tuple(size for axis, size in enumerate(shape) if axis != draw_axis)
+    summary_chunk_axis = chunk_axis - int(chunk_axis > draw_axis)
+    bytes_per_index = 8 * int(np.prod(shape)) // max(1, shape[chunk_axis])
+    step = max(1, chunk_bytes // max(1, bytes_per_index))
+
+    mean = np.empty(summary_shape)
+    var = np.empty(summary_shape)
+    quantile_values = np.empty((len(quantiles),) + summary_shape)
+    for start in range(0, shape[chunk_axis], step):
+        block_index = [slice(None)] * len(shape)
+        block_index[chunk_axis] = slice(start, start + step)
+        summary_index = [slice(None)] * len(summary_shape)
+        summary_index[summary_chunk_axis] = slice(start, start + step)
+        summary_index = tuple(summary_index)
+
+        block = np.asarray(draws[tuple(block_index)], dtype=float)
+        mean[summary_index] = block.mean(axis=draw_axis)
+        var[summary_index] = block.var(axis=draw_axis)
+        quantile_values[(slice(None),) + summary_index] = np.quantile(
+            block, quantiles, axis=draw_axis
+        )
+    return {"mean": mean, "var": var, "quantiles": quantile_values}
+
+
+def interval_coverage(
+    target: np.ndarray, lower: np.ndarray, upper: np.ndarray, axis: int = None
+):
+    """Share of the target values within [lower, upper], missing ones excluded."""
+    inside = np.where(
+        np.isnan(target), np.nan, (lower <= target) & (target <= upper)
     )
+    return np.nanmean(inside, axis=axis)
+
+
+def max_pm25_diff_per_cluster(target: np.ndarray, salso_partition: np.array):
+    statistics = cluster_statistics(target[None, :], salso_partition[None, :])
+    return np.nanmax(statistics["range"])
+
+
+def weekly_cluster_kpis(target: np.ndarray, partitions: np.ndarray) -> dict:
+    """
+    ``max_pm25_diff`` and the ``cluster_size_weekly_kpi`` of every week, as
+    lists, from one ``cluster_statistics`` pass over all weeks.
+    """
+    statistics = cluster_statistics(target, partitions)
+    weekly_kpis = {"max_pm25_diff": np.nanmax(statistics["range"], axis=1).tolist()}
+    for key, kpi in cluster_size_weekly_kpi.items():
+        weekly_kpis[key] = kpi(statistics["size"]).tolist()
+    return weekly_kpis
+
+
+def cluster_statistics(target: np.ndarray, partitions: np.ndarray) -> dict:
+    """
+    Size, min, max, mean and range of the ``target`` values within every
+    cluster of every week, for ``target`` and ``partitions`` of shape (n_weeks,
+    n_stations). Every result has the shape (n_weeks, n_labels) and is indexed
+    by the cluster label; labels not used in a week have size 0 and NaN values.
+    """
+    partitions = np.asarray(partitions, dtype=int)
+    target = np.asarray(target, dtype=float)
+    n_weeks = partitions.shape[0]
+    n_labels = partitions.max() + 1
+    # one group per week and label, the reductions run over all weeks at once
+    groups = (partitions + n_labels * np.arange(n_weeks)[:, None]).ravel()
+    values = target.ravel()
+    sizes = np.bincount(groups, minlength=n_weeks * n_labels)
+    sums = np.bincount(groups, weights=values, minlength=n_weeks * n_labels)
+
+    used = np.flatnonzero(sizes)
+    starts = np.concatenate([[0], np.cumsum(sizes[used])[:-1]])
+    sorted_values = values[np.argsort(groups, kind="stable")]
+    minimum = np.full(sizes.shape, np.nan)
+    maximum = np.full(sizes.shape, np.nan)
+    minimum[used] = np.minimum.reduceat(sorted_values, starts)
+    maximum[used] = np.maximum.reduceat(sorted_values, starts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(sizes > 0, sums / sizes, np.nan)
+
+    shape = (n_weeks, n_labels)
+    return {
+        "size": sizes.reshape(shape),
+        "min": minimum.reshape(shape),
+        "max": maximum.reshape(shape),
+        "mean": mean.reshape(shape),
+        "range": (maximum - minimum).reshape(shape),
+    }
 
 
 def laggedRI(firstweek: int, lastweek: int, salso_pars: np.array):
     len = lastweek - firstweek + 1
-    RImatrix = np.zeros((len, len))
-    for i in range(len):
-        for j in range(i + 1):
-            ri = salso.RI(
-                to_r_int_vector(salso_pars[i]), to_r_int_vector(salso_pars[j])
-            )[0]
-            RImatrix[i, j] = ri
-            RImatrix[j, i] = ri
-    return RImatrix
+    return rand_indices(salso_pars[:len])[0]
 
 
 def laggedARI(firstweek: int, lastweek: int, salso_pars: np.array):
     len = lastweek - firstweek + 1
-    ARImatrix = np.zeros((len, len))
-    for i in range(len):
-        for j in range(i + 1):
-            ari = adjusted_rand_score(salso_pars[i], salso_pars[j])
-            ARImatrix[i, j] = ari
-            ARImatrix[j, i] = ari
-    return ARImatrix
+    return rand_indices(salso_pars[:len])[1]
+
+
+def rand_indices(
+    partitions: np.ndarray, other: np.ndarray = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Rand index and adjusted Rand index of all pairs of the rows of
+    ``partitions`` (n_weeks, n_stations), or of the rows of ``partitions`` and
+    ``other`` (e.g. another model or year), shape (n_weeks, n_other_weeks).
+
+    Both follow from the pair counts of the contingency tables, which are
+    computed for all pairs at once: the number of station pairs clustered
+    together in two partitions is the product of their pair indicators.
+    """
+    partitions = np.atleast_2d(partitions)
+    other = partitions if other is None else np.atleast_2d(other)
+    n_pairs = partitions.shape[1] * (partitions.shape[1] - 1) / 2
+    together, other_together = _pairs_together(partitions), _pairs_together(other)
+    both = together @ other_together.T
+    first = together.sum(axis=1)[:, None]
+    second = other_together.sum(axis=1)[None, :]
+
+    ri = (n_pairs - first - second + 2 * both) / n_pairs
+    expected = first * second / n_pairs
+    maximum = (first + second) / 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ari = (both - expected) / (maximum - expected)
+    # equal trivial partitions (all singletons or one cluster) agree perfectly
+    ari[maximum == expected] = 1.0
+    return ri, ari
+
+
+def _pairs_together(partitions: np.ndarray) -> np.ndarray:
+    """Indicators of the station pairs in the same cluster, (n_weeks, n_pairs)."""
+    first, second = np.triu_indices(partitions.shape[1], k=1)
+    return (partitions[:, first] == partitions[:, second]).astype(float)
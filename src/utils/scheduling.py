@@ -0,0 +1,166 @@
+import heapq
+import json
+import logging
+import os
+from datetime import timedelta
+from pathlib import Path
+
+import numpy as np
+import rpy2.robjects as ro
+
+"""
+Runtime model of the fits and scheduling of sweeps. Every fit appends its time
+(as measured by ``log_time``) together with its size and options to a log. The
+expected runtime of a new fit is its amount of work (draws x stations x
+timesteps) times the median time per unit of work of the logged fits with the
+same model and options, which lets ``run_grid`` start the expensive cases first
+and estimate the duration of a sweep before it starts.
+"""
+
+runtime_log_path = os.path.join(
+    Path(__file__).parent.parent.parent, "data/.cache/runtimes.jsonl"
+)
+# seconds per draw, station and timestep if nothing was logged yet
+default_rate = 2e-5
+
+# arguments which change the cost of a fit beyond its size
+categorical_args = [
+    "SpatialCohesion",
+    "unit_specific_alpha",
+    "time_specific_alpha",
+    "alpha_0",
+    "eta1_0",
+    "phi1_0",
+    "simpleModel",
+    "cohesion",
+    "PPM",
+    "meanModel",
+    "similarity_function",
+    "consim",
+    "calibrate",
+]
+
+
+def fit_features(
+    model: str,
+    args: dict,
+    n_stations: int,
+    n_timesteps: int = 1,
+    spatial: bool = True,
+) -> dict:
+    """Size and options of a fit with the model arguments ``args``."""
+    draws = args.get("draws", 1)
+    if args.get("adaptive") is not None:
+        draws = args["adaptive"].max_draws
+    return {
+        "model": model,
+        "draws": int(draws),
+        "n_stations": int(n_stations),
+        "n_timesteps": int(n_timesteps),
+        "spatial": bool(spatial),
+        "options": {
+            name: _plain(args[name]) for name in categorical_args if name in args
+        },
+    }
+
+
+def features_of_fit(model: str, kwargs: dict) -> dict:
+    """
+    Features of a fit from the arguments passed to R. A fit is spatial if it
+    got coordinates, as predicted by ``Model.uses_coordinates``.
+    """
+    n_stations, n_timesteps = _r_shape(kwargs["y"])
+    coords = kwargs.get("s_coords", kwargs.get("s"))
+    return fit_features(
+        model,
+        kwargs,
+        n_stations=n_stations,
+        n_timesteps=n_timesteps,
+        spatial=coords is not None and len(coords) > 0,
+    )
+
+
+def log_runtime(model: str, kwargs: dict, time_needed: float, path: str = None):
+    """Append the time of a fit to the runtime log."""
+    path = runtime_log_path if path is None else path
+    try:
+        record = features_of_fit(model, kwargs) | {"time": time_needed}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a") as file:
+            file.write(json.dumps(record) + "\n")
+    except (OSError, KeyError, TypeError) as exc:
+        logging.warning("Could not log the runtime of {}: {}".format(model, exc))
+
+
+class RuntimeModel:
+    """Expected runtime of fits, learned from the runtime log."""
+
+    def __init__(self, records: list[dict] = None):
+        self._rates: dict[tuple, list[float]] = {}
+        for record in records or []:
+            rate = record["time"] / max(1, work(record))
+            for key in self._keys(record):
+                self._rates.setdefault(key, []).append(rate)
+
+    @classmethod
+    def load(cls, path: str = None) -> "RuntimeModel":
+        path = runtime_log_path if path is None else path
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as file:
+            return cls([json.loads(line) for line in file if line.strip()])
+
+    def predict(self, features: dict) -> float:
+        """Expected seconds, from the most specific group with logged fits."""
+        for key in self._keys(features):
+            if key in self._rates:
+                return float(np.median(self._rates[key])) * work(features)
+        return default_rate * work(features)
+
+    @staticmethod
+    def _keys(features: dict) -> list[tuple]:
+        # from the most to the least specific group
+        options = json.dumps(features["options"], sort_keys=True)
+        return [
+            (features["model"], features["spatial"], options),
+            (features["model"],),
+            (),
+        ]
+
+
+def work(features: dict) -> int:
+    return features["draws"] * features["n_stations"] * features["n_timesteps"]
+
+
+def longest_first(costs: list[float]) -> list[int]:
+    """Indices of the tasks, the most expensive first."""
+    return sorted(range(len(costs)), key=lambda idx: -costs[idx])
+
+
+def estimate_makespan(costs: list[float], n_workers: int) -> float:
+    """Duration if the tasks are started longest first on ``n_workers``."""
+    finish_times = [0.0] * max(1, n_workers)
+    for idx in longest_first(costs):
+        heapq.heapreplace(finish_times, finish_times[0] + costs[idx])
+    return max(finish_times)
+
+
+def format_duration(seconds: float) -> str:
+    return str(timedelta(seconds=round(seconds)))
+
+
+def _r_shape(values) -> tuple[int, int]:
+    """(rows, columns) of an R vector or matrix, a vector is one column."""
+    dims = list(ro.r["dim"](values))
+    if len(dims) == 2:
+        return int(dims[0]), int(dims[1])
+    return len(values), 1
+
+
+def _plain(value):
+    """Json representation of an argument."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (bool, int, float, str)) or value is None:
+        return value
+    return repr(value)
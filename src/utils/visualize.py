@@ -10,6 +10,7 @@ import plotly.express as px
 import seaborn as sns
 from tabulate import tabulate
 
+from utils.partition import PosteriorSimilarity
 from utils.results import YearlyPerformance, cluster_size_weekly_kpi
 
 report_path = os.path.join(Path(__file__).parent.parent.parent, "report/")
@@ -271,3 +272,46 @@ def plot_weekly_clustering_kpi_overview(
     plt.legend(loc="upper right")
     plt.title("Weekly Clustering")
     plt.show()
+
+
+def plot_posterior_similarity(
+    similarity: PosteriorSimilarity,
+    weeks: list[int],
+    partitions: np.ndarray = None,
+) -> None:
+    """
+    Heatmaps of the posterior similarity matrices of some weeks (counted from
+    1). With ``partitions`` (n_weeks, n_stations), e.g. the salso estimates, the
+    stations are ordered by their cluster.
+    """
+    fig, axes = plt.subplots(
+        nrows=1, ncols=len(weeks), figsize=(5 * len(weeks), 4.5), squeeze=False
+    )
+    for ax, week in zip(axes[0], weeks):
+        psm = similarity.psm[week - 1]
+        if partitions is not None:
+            order = np.argsort(partitions[week - 1], kind="stable")
+            psm = psm[np.ix_(order, order)]
+        sns.heatmap(psm, vmin=0, vmax=1, cmap="viridis", square=True, ax=ax)
+        ax.set_title("Week {}".format(week))
+        ax.set_xlabel("Stations")
+        ax.set_ylabel("Stations")
+    plt.suptitle("Posterior similarity of {} draws".format(similarity.n_draws))
+    plt.tight_layout()
+    plt.show()
+
+
+def plot_coclustering_uncertainty(similarity: PosteriorSimilarity) -> None:
+    """Co-clustering uncertainty (``PosteriorSimilarity.uncertainty``) per week."""
+    uncertainty = similarity.uncertainty()
+    plt.figure(figsize=(12, 6))
+    plt.imshow(uncertainty.T, aspect="auto", cmap="magma", vmin=0, vmax=0.25)
+    plt.colorbar(label="mean p(1 - p)")
+    plt.xticks(
+        np.arange(0, uncertainty.shape[0], 4),
+        np.arange(1, uncertainty.shape[0] + 1, 4),
+    )
+    plt.xlabel("Weeks")
+    plt.ylabel("Stations")
+    plt.title("Uncertainty of the clustering of every station")
+    plt.show()